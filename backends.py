@@ -0,0 +1,277 @@
+import datetime
+from abc import ABC, abstractmethod
+from urllib.parse import urljoin
+
+import httpx
+import lxml.html
+
+import config
+import logger
+from executors import run_scrape
+from lookupcache import LookupCache, last_chapter_cache, search_cache
+from metrics import page_load_seconds, scraper_errors, scraper_seconds, timed
+from ratelimit import adaptive_limiter, host_limiter
+from scraper import CHAPTER_ROWS_XPATH, Chapter, Manga, MangaScraper
+
+log = logger.get_logger(__name__)
+
+HOMEPAGE = config.WEEBCENTRAL_URL
+
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/115.0.0.0 Safari/537.36"
+    )
+}
+
+# visible text only, the same thing selenium's `.text` would give us
+VISIBLE_TEXT = ".//text()[normalize-space() and not(ancestor::script) and not(ancestor::style)]"
+
+
+class NeedsJavaScript(Exception):
+    """Raised by a backend when the data is not in the static HTML of the page."""
+
+
+class ScraperBackend(ABC):
+    """Read-only scraping operations on WeebCentral pages, mirroring `MangaScraper`."""
+
+    @abstractmethod
+    async def get_queried_mangas(self, query: str) -> list[Manga]: ...
+
+    @abstractmethod
+    async def get_last_chapter(self, manga: Manga) -> Chapter: ...
+
+    @abstractmethod
+    async def get_chapters(self, manga: Manga) -> list[Chapter]: ...
+
+    @abstractmethod
+    async def get_data_from_chapter_url(self, chapter_url: str) -> tuple[str, str]: ...
+
+    @abstractmethod
+    async def get_chapter_image_urls(self, chapter_url: str) -> list[str]: ...
+
+    async def close(self) -> None:
+        pass
+
+
+class SeleniumBackend(ScraperBackend):
+    """Runs every call on a pooled browser, on the scraping thread pool."""
+
+    @staticmethod
+    def _run(method: str, *args):
+        with MangaScraper() as scraper:
+            return getattr(scraper, method)(*args)
+
+    @staticmethod
+    def _search(query: str) -> list[Manga]:
+        with MangaScraper() as scraper:
+            scraper.go_to_homepage()
+            return scraper.get_queried_mangas(query)
+
+    async def get_queried_mangas(self, query: str) -> list[Manga]:
+        await host_limiter.acquire(HOMEPAGE)
+        # the adaptive limiter slot is taken by the scraper around the page load itself
+        return await run_scrape(self._search, query)
+
+    async def _call(self, url: str, method: str, *args):
+        await host_limiter.acquire(url)
+        return await run_scrape(self._run, method, *args)
+
+    async def get_last_chapter(self, manga: Manga) -> Chapter:
+        return await self._call(manga.url, "get_last_chapter", manga)
+
+    async def get_chapters(self, manga: Manga) -> list[Chapter]:
+        return await self._call(manga.url, "get_chapters", manga)
+
+    async def get_data_from_chapter_url(self, chapter_url: str) -> tuple[str, str]:
+        return await self._call(chapter_url, "get_data_from_chapter_url", chapter_url)
+
+    async def get_chapter_image_urls(self, chapter_url: str) -> list[str]:
+        return await self._call(chapter_url, "get_chapter_image_urls", chapter_url)
+
+
+class HttpBackend(ScraperBackend):
+    """Fetches pages with a pooled httpx client and reads them with lxml XPath, no browser involved."""
+
+    def __init__(self, max_connections: int = 20, timeout: float = 15) -> None:
+        self.client = httpx.AsyncClient(
+            headers=HEADERS,
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def _fetch(self, url: str) -> lxml.html.HtmlElement:
+        await host_limiter.acquire(url)
+        async with adaptive_limiter.for_url(url).async_slot() as slot:
+            with page_load_seconds.time(backend="http"):
+                response = await self.client.get(url)
+            slot.record_status(response.status_code)
+        response.raise_for_status()
+        tree = lxml.html.fromstring(response.content, base_url=str(response.url))
+        tree.make_links_absolute()
+        return tree
+
+    @staticmethod
+    def _first(elements: list, what: str, url: str):
+        if not elements:
+            raise NeedsJavaScript(f"No {what} in the static HTML of {url}")
+        return elements[0]
+
+    @staticmethod
+    def _text(element: lxml.html.HtmlElement) -> str:
+        return " ".join(t.strip() for t in element.xpath(VISIBLE_TEXT))
+
+    async def get_queried_mangas(self, query: str) -> list[Manga]:
+        # results are only rendered by the quick search box on the homepage
+        raise NeedsJavaScript("Search needs the homepage quick search")
+
+    def _chapter_from_div(self, chapter_div: lxml.html.HtmlElement, url: str) -> Chapter:
+        date = self._first(chapter_div.xpath(".//time/@datetime"), "chapter date", url)
+        a = self._first(chapter_div.xpath(".//a[@href]"), "chapter link", url)
+        title_parts = a.xpath(VISIBLE_TEXT)
+        return Chapter(
+            title=title_parts[0].strip() if title_parts else "",
+            url=a.get("href"),
+            published_at=datetime.datetime.fromisoformat(date)
+        )
+
+    @timed(scraper_seconds, scraper_errors, backend="http", operation="get_last_chapter")
+    async def get_last_chapter(self, manga: Manga) -> Chapter:
+        tree = await self._fetch(manga.url)
+        last_chapter_div = self._first(tree.xpath("//*[@id='chapter-list']//div"), "#chapter-list", manga.url)
+        last_chapter = self._chapter_from_div(last_chapter_div, manga.url)
+        if not manga.last_chapter:
+            manga.add_chapter(last_chapter)
+
+        return last_chapter
+
+    @timed(scraper_seconds, scraper_errors, backend="http", operation="get_chapters")
+    async def get_chapters(self, manga: Manga) -> list[Chapter]:
+        tree = await self._fetch(manga.url)
+        chapter_divs = tree.xpath(CHAPTER_ROWS_XPATH)
+        if not chapter_divs:
+            raise NeedsJavaScript(f"No chapters in the static HTML of {manga.url}")
+        return [self._chapter_from_div(chapter_div, manga.url) for chapter_div in chapter_divs]
+
+    @timed(scraper_seconds, scraper_errors, backend="http", operation="get_data_from_chapter_url")
+    async def get_data_from_chapter_url(self, chapter_url: str) -> tuple[str, str]:
+        tree = await self._fetch(chapter_url)
+        manga_title = self._first(tree.xpath("/html/body/main/section[1]/div/div[1]/a/div"), "manga title", chapter_url)
+        chapter_title = self._first(tree.xpath("/html/body/main/section[1]/div/div[1]/button[1]"), "chapter title", chapter_url)
+        return self._text(manga_title), self._text(chapter_title)
+
+    @timed(scraper_seconds, scraper_errors, backend="http", operation="get_chapter_image_urls")
+    async def get_chapter_image_urls(self, chapter_url: str) -> list[str]:
+        tree = await self._fetch(chapter_url)
+        container = self._first(tree.xpath("/html/body/main/section[3]"), "image container", chapter_url)
+        image_urls = container.xpath(".//img/@src")
+        if not image_urls:
+            # the reader is usually filled by an htmx request fired on load, follow it ourselves
+            fragment_urls = container.xpath("descendant-or-self::*[@hx-get]/@hx-get")
+            if fragment_urls:
+                fragment = await self._fetch(urljoin(tree.base_url, fragment_urls[0]))
+                image_urls = fragment.xpath("//img/@src")
+        if not image_urls:
+            raise NeedsJavaScript(f"No images in the static HTML of {chapter_url}")
+        return image_urls
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class FallbackBackend(ScraperBackend):
+    """Tries `primary` first and retries a single call on `fallback` when the page needs JavaScript."""
+
+    def __init__(self, primary: ScraperBackend, fallback: ScraperBackend) -> None:
+        self.primary = primary
+        self.fallback = fallback
+
+    async def _call(self, method: str, *args):
+        try:
+            return await getattr(self.primary, method)(*args)
+        except NeedsJavaScript as e:
+            log.info(f"{method} falling back to {type(self.fallback).__name__}: {e}")
+            return await getattr(self.fallback, method)(*args)
+
+    async def get_queried_mangas(self, query: str) -> list[Manga]:
+        return await self._call("get_queried_mangas", query)
+
+    async def get_last_chapter(self, manga: Manga) -> Chapter:
+        return await self._call("get_last_chapter", manga)
+
+    async def get_chapters(self, manga: Manga) -> list[Chapter]:
+        return await self._call("get_chapters", manga)
+
+    async def get_data_from_chapter_url(self, chapter_url: str) -> tuple[str, str]:
+        return await self._call("get_data_from_chapter_url", chapter_url)
+
+    async def get_chapter_image_urls(self, chapter_url: str) -> list[str]:
+        return await self._call("get_chapter_image_urls", chapter_url)
+
+    async def close(self) -> None:
+        await self.primary.close()
+        await self.fallback.close()
+
+
+class CachingBackend(ScraperBackend):
+    """Serves searches and last chapters from lookup caches in front of another backend.
+
+    Every `get_chapters` call, the notifier's, replaces the cached last chapter
+    of its manga, so a new chapter invalidates the stale one right away.
+    """
+
+    def __init__(self, backend: ScraperBackend, search_cache: LookupCache, last_chapter_cache: LookupCache) -> None:
+        self.backend = backend
+        self.search_cache = search_cache
+        self.last_chapter_cache = last_chapter_cache
+
+    async def get_queried_mangas(self, query: str) -> list[Manga]:
+        key = " ".join(query.lower().split())
+        mangas = await self.search_cache.get(key)
+        if mangas is None:
+            mangas = await self.backend.get_queried_mangas(query)
+            if mangas:
+                await self.search_cache.put(key, mangas)
+        # callers keep the mangas and add chapters to them
+        return [Manga(title=manga.title, url=manga.url) for manga in mangas]
+
+    async def get_last_chapter(self, manga: Manga) -> Chapter:
+        last_chapter = await self.last_chapter_cache.get(manga.url)
+        if last_chapter is None:
+            last_chapter = await self.backend.get_last_chapter(manga)
+            if last_chapter:
+                await self.last_chapter_cache.put(manga.url, last_chapter)
+        elif not manga.last_chapter:
+            manga.add_chapter(last_chapter)
+        return last_chapter
+
+    async def get_chapters(self, manga: Manga) -> list[Chapter]:
+        chapters = await self.backend.get_chapters(manga)
+        if chapters:
+            await self.last_chapter_cache.put(manga.url, chapters[0])
+        return chapters
+
+    async def get_data_from_chapter_url(self, chapter_url: str) -> tuple[str, str]:
+        return await self.backend.get_data_from_chapter_url(chapter_url)
+
+    async def get_chapter_image_urls(self, chapter_url: str) -> list[str]:
+        return await self.backend.get_chapter_image_urls(chapter_url)
+
+    async def close(self) -> None:
+        log.info(f"Lookup cache hit ratios: search={self.search_cache.hit_ratio:.2f} "
+                 f"last_chapter={self.last_chapter_cache.hit_ratio:.2f}")
+        await self.backend.close()
+
+
+def create_backend(name: str) -> ScraperBackend:
+    if name == "selenium":
+        return SeleniumBackend()
+    if name == "http":
+        return FallbackBackend(HttpBackend(max_connections=config.HTTP_MAX_CONNECTIONS), SeleniumBackend())
+    raise ValueError(f"Unknown scraper backend: {name}")
+
+
+# global scraper backend instance
+backend = CachingBackend(create_backend(config.SCRAPER_BACKEND), search_cache, last_chapter_cache)
@@ -0,0 +1,209 @@
+"""End-to-end benchmarks of the bot against a local fakesite.py, results written as JSON.
+
+    python bench.py --mangas 50 --pages 40 --output results.json
+    python bench.py --compare results.json --output new.json
+
+Runs in a temporary working directory, so the database and chapter cache of
+the bot are left alone. Settings from the environment and .env (e.g.
+HOST_RATE_LIMIT, DOWNLOAD_WORKERS) apply as they would to the bot.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import config
+from fakesite import FakeSite, serve
+
+SCENARIOS = ("notifier", "download", "add")
+
+
+def summarize(latencies: list[float], wall_time: float, items: int, errors: int = 0) -> dict:
+    """Latency percentiles in seconds and throughput in items per second."""
+    if not latencies:
+        return {"count": 0, "errors": errors}
+    ordered = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "wall_time": wall_time,
+        "throughput": items / wall_time if wall_time else None,
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+
+async def bench_notifier(site: FakeSite, base_url: str, iterations: int) -> dict:
+    """Notifier runs over every manga, each run finding one new chapter per manga."""
+    import tg
+    from repo import mangaRepo
+    from scheduler import poll_scheduler
+    from scraper import Chapter, Manga
+
+    # one subscriber per manga, up to date with the site
+    for manga_id, count in enumerate(site.chapter_counts):
+        last_chapter = Chapter(f"Chapter {count}", base_url.rstrip("/") + site.chapter_path(manga_id, count),
+                               datetime.datetime.fromisoformat(site.published_at(count)))
+        manga = Manga(site.title(manga_id), base_url.rstrip("/") + site.manga_path(manga_id), last_chapter)
+        mangaRepo.save_manga(manga_id, manga)
+
+    latencies, wall_time, changed, failed = [], 0.0, 0, 0
+    for _ in range(iterations):
+        site.release_all()
+        # forget the schedule so every manga is due again
+        poll_scheduler.sync([])
+        started = time.monotonic()
+        summary = await tg.notifier(None)
+        wall_time += time.monotonic() - started
+        latencies.extend(summary.latencies)
+        changed += summary.changed
+        failed += summary.failed
+    result = summarize(latencies, wall_time, len(latencies), failed)
+    result["changed"] = changed
+    return result
+
+
+def bench_download(site: FakeSite, base_url: str, iterations: int) -> dict:
+    """Building a chapter PDF of `site.pages` pages, a different chapter each iteration."""
+    from downloader import download_pdf
+
+    latencies, total_bytes = [], 0
+    for iteration in range(iterations):
+        number = iteration % min(site.chapter_counts) + 1
+        urls = [f"{base_url}images/0/{number}/{page}.jpg" for page in range(1, site.pages + 1)]
+        started = time.monotonic()
+        with download_pdf(urls) as pdf:
+            total_bytes += pdf.seek(0, os.SEEK_END)
+        latencies.append(time.monotonic() - started)
+    wall_time = sum(latencies)
+    result = summarize(latencies, wall_time, site.pages * iterations)
+    result["pdf_mb_per_s"] = total_bytes / wall_time / 2**20
+    return result
+
+
+async def bench_add(site: FakeSite, iterations: int) -> dict:
+    """The /add flow: search, last chapter of the first result, saving the subscription."""
+    from backends import backend
+    from executors import run_db
+    from repo import mangaRepo
+
+    latencies, errors, last_error = [], 0, None
+    for iteration in range(iterations):
+        started = time.monotonic()
+        try:
+            mangas = await backend.get_queried_mangas(site.title(iteration % len(site.chapter_counts)))
+            manga = mangas[0]
+            await backend.get_last_chapter(manga)
+            await run_db(mangaRepo.save_manga, -1 - iteration, manga)
+        except Exception as e:
+            errors += 1
+            last_error = repr(e)
+            continue
+        latencies.append(time.monotonic() - started)
+    result = summarize(latencies, sum(latencies), len(latencies), errors)
+    if last_error:
+        result["last_error"] = last_error
+    return result
+
+
+async def run(site: FakeSite, base_url: str, scenarios: list[str], iterations: int) -> dict:
+    import executors
+    from backends import backend
+    from pool import browser_pool
+
+    results = {}
+    try:
+        if "notifier" in scenarios:
+            results["notifier"] = await bench_notifier(site, base_url, iterations)
+        if "download" in scenarios:
+            results["download"] = bench_download(site, base_url, iterations)
+        if "add" in scenarios:
+            results["add"] = await bench_add(site, iterations)
+    finally:
+        await backend.close()
+        browser_pool.close()
+        executors.shutdown()
+    return results
+
+
+def compare(baseline: dict, current: dict) -> None:
+    """Print the change of the median latency and throughput of every scenario."""
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        for metric in ("p50", "throughput"):
+            old, new = before.get(metric), result.get(metric)
+            if old and new:
+                print(f"{name} {metric}: {old:.4f} -> {new:.4f} ({(new - old) / old:+.1%})")
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--mangas", type=int, default=20)
+    parser.add_argument("--chapters", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    scenarios = [name for name in args.scenarios.split(",") if name]
+
+    site = FakeSite(args.mangas, args.chapters, args.pages, latency=args.latency,
+                    jitter=args.jitter, error_rate=args.error_rate)
+    server = serve(site)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+    # config is already loaded (the logger reads it), but the scraping modules are not imported yet
+    config.WEEBCENTRAL_URL = base_url
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    results = asyncio.run(run(site, base_url, scenarios, args.iterations))
+    server.shutdown()
+
+    report = {
+        "started_at": started_at,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "requests_served": site.requests,
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import BinaryIO
+
+import config
+import logger
+from db import ChapterCacheRepository, PageCacheRepository
+from repo import chapterCacheRepo, pageCacheRepo
+
+log = logger.get_logger(__name__)
+
+
+@dataclass
+class CacheEntry:
+    path: str
+    filename: str
+    size: int
+
+
+class ChapterCache:
+    """Finished chapter PDFs on disk, keyed by chapter URL, evicted least recently used first."""
+
+    def __init__(self, directory: str, max_bytes: int, repository: ChapterCacheRepository) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.repository = repository
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, chapter_url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(chapter_url.encode()).hexdigest() + ".pdf")
+
+    def get(self, chapter_url: str) -> CacheEntry | None:
+        row = self.repository.find_entry(chapter_url)
+        if row is None:
+            return None
+        entry = CacheEntry(*row)
+        if not os.path.exists(entry.path):
+            log.warning(f"Cached PDF of {chapter_url} is missing from disk, dropping it from the index.")
+            self.repository.delete_entry(chapter_url)
+            return None
+        self.repository.touch_entry(chapter_url, time.time())
+        return entry
+
+    def open(self, chapter_url: str) -> tuple[BinaryIO, str] | None:
+        """Open a cached PDF, returning the file and its document filename, or None on a miss."""
+        entry = self.get(chapter_url)
+        if entry is None:
+            return None
+        try:
+            # an open file stays readable even if it is evicted right after
+            return open(entry.path, "rb"), entry.filename
+        except FileNotFoundError:
+            self.repository.delete_entry(chapter_url)
+            return None
+
+    def contains(self, chapter_url: str) -> bool:
+        """Whether a chapter is cached, without counting as an access."""
+        return self.repository.find_entry(chapter_url) is not None
+
+    def prefetched_size(self) -> int:
+        return self.repository.prefetched_size()
+
+    def put(self, chapter_url: str, pdf: BinaryIO, filename: str, prefetched: bool = False) -> CacheEntry:
+        """Store a PDF atomically: readers see either no file or the complete one.
+
+        `prefetched` marks a PDF built before anyone asked for it, until its first access.
+        """
+        path = self._path(chapter_url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(pdf, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        entry = CacheEntry(path, filename, os.path.getsize(path))
+        with self._lock:
+            self.repository.save_entry(chapter_url, entry.path, entry.filename, entry.size, time.time(), prefetched)
+            self._evict(keep=chapter_url)
+        log.info(f"Cached {filename} ({entry.size / 1024 / 1024:.1f}MB).")
+        return entry
+
+    def _evict(self, keep: str) -> None:
+        """Drop least recently used PDFs until the cache fits its budget, never evicting `keep`."""
+        total = self.repository.total_size()
+        while total > self.max_bytes:
+            victims = [victim for victim in self.repository.find_least_recent(16) if victim[0] != keep]
+            if not victims:
+                return
+            for chapter_url, path, size in victims:
+                if total <= self.max_bytes:
+                    return
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.repository.delete_entry(chapter_url)
+                total -= size
+                log.info(f"Evicted {chapter_url} from the chapter cache.")
+
+
+# global chapter cache
+chapter_cache = ChapterCache(config.CHAPTER_CACHE_DIR, config.CHAPTER_CACHE_MAX_MB * 1024 * 1024, chapterCacheRepo)
+
+
+@dataclass
+class PageEntry:
+    url: str
+    hash: str
+    path: str
+    etag: str | None
+    last_modified: str | None
+    validated_at: float
+
+
+class PageCache:
+    """Downloaded page images on disk, so a chapter built again only downloads the pages it misses.
+
+    Files are named after the sha256 of their content, a page served under
+    several urls is stored once. Pages older than `revalidate_after` are
+    checked with the site (ETag / Last-Modified) before being reused, the
+    least recently used are evicted past `max_bytes`. Chapter builds spool
+    their pages in `spool_dir`, on the same filesystem, so pages move in and
+    out of the cache as hard links instead of copies.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, revalidate_after: float, repository: PageCacheRepository) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.repository = repository
+        self.spool_dir = os.path.join(directory, "spool") if self.enabled else None
+        self._lock = threading.Lock()
+        self._total: int | None = None
+        if self.enabled:
+            os.makedirs(self.spool_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash[:2], content_hash)
+
+    def lookup(self, url: str) -> PageEntry | None:
+        if not self.enabled:
+            return None
+        try:
+            row = self.repository.find_entry(url)
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        content_hash, _, etag, last_modified, validated_at = row
+        return PageEntry(url, content_hash, self._path(content_hash), etag, last_modified, validated_at)
+
+    def is_fresh(self, entry: PageEntry) -> bool:
+        return time.time() - entry.validated_at < self.revalidate_after
+
+    @staticmethod
+    def conditional_headers(entry: PageEntry) -> dict[str, str]:
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def restore(self, entry: PageEntry, path: str, validated: bool = False) -> bool:
+        """Put a cached page at `path`. Returns False when its file is gone, e.g. evicted meanwhile."""
+        try:
+            try:
+                os.link(entry.path, path)
+            except OSError as e:
+                if isinstance(e, FileNotFoundError):
+                    raise
+                shutil.copyfile(entry.path, path)
+        except FileNotFoundError:
+            self.forget(entry.url)
+            return False
+        try:
+            self.repository.touch_entry(entry.url, time.time(), validated)
+        except sqlite3.Error:
+            pass  # only its place in the eviction order is lost
+        return True
+
+    def forget(self, url: str) -> None:
+        try:
+            self.repository.delete_entry(url)
+        except sqlite3.Error:
+            pass
+
+    def store(self, url: str, path: str, etag: str | None, last_modified: str | None) -> None:
+        """Keep a copy of the page just downloaded to `path`. Best effort, a failure only costs a download later."""
+        if not self.enabled:
+            return
+        try:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            content_hash = digest.hexdigest()
+            size = os.path.getsize(path)
+            blob = self._path(content_hash)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            with self._lock:
+                total = self._current_total()
+                try:
+                    os.link(path, blob)
+                    added = size
+                except FileExistsError:
+                    added = 0  # same content under another url, or stored again
+                except OSError:
+                    shutil.copyfile(path, blob)
+                    added = size
+                old = self.repository.find_entry(url)
+                self.repository.save_entry(url, content_hash, size, etag, last_modified, time.time())
+                if old is not None and old[0] != content_hash:
+                    total -= self._release(old[0], old[1])
+                self._total = total + added
+                self._evict(keep=url)
+        except (OSError, sqlite3.Error) as e:
+            log.warning(f"Could not cache page {url}: {e}")
+
+    def _current_total(self) -> int:
+        if self._total is None:
+            self._total = self.repository.total_size()
+        return self._total
+
+    def _release(self, content_hash: str, size: int) -> int:
+        """Delete the file of a content nothing refers to anymore, returning the bytes freed."""
+        if self.repository.count_hash(content_hash):
+            return 0
+        try:
+            os.remove(self._path(content_hash))
+        except FileNotFoundError:
+            pass
+        return size
+
+    def _evict(self, keep: str) -> None:
+        """Drop least recently used pages until the cache fits its budget, never evicting `keep`."""
+        while self._total > self.max_bytes:
+            victims = [victim for victim in self.repository.find_least_recent(64) if victim[0] != keep]
+            if not victims:
+                return
+            for url, content_hash, size in victims:
+                if self._total <= self.max_bytes:
+                    return
+                self.repository.delete_entry(url)
+                self._total -= self._release(content_hash, size)
+
+
+# global page image cache
+page_cache = PageCache(config.PAGE_CACHE_DIR, config.PAGE_CACHE_MAX_MB * 1024 * 1024,
+                       config.PAGE_CACHE_REVALIDATE, pageCacheRepo)
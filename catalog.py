@@ -0,0 +1,147 @@
+import asyncio
+import difflib
+import itertools
+import re
+import string
+import time
+
+import config
+import logger
+from backends import ScraperBackend, backend
+from db import CatalogRepository
+from executors import run_db
+from repo import catalogRepo
+from scraper import Manga
+
+log = logger.get_logger(__name__)
+
+WORD = re.compile(r"\w+")
+# how close a misspelled word must be to an indexed one to be corrected
+FUZZY_CUTOFF = 0.75
+
+
+def match_expression(words: list[str]) -> str:
+    """FTS5 query matching titles with a word starting with each of `words`."""
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class Catalog:
+    """Answers manga searches from the local index, scraping only when it has to.
+
+    A query is matched as word prefixes, ranked by bm25. When nothing matches,
+    misspelled words are corrected against the indexed vocabulary. Only a query
+    that still finds nothing is scraped live. Hits on entries older than
+    `max_age` are returned right away and refreshed in the background.
+    """
+
+    def __init__(self, repository: CatalogRepository, backend: ScraperBackend, max_age: float,
+                 limit: int, crawl_batch: int) -> None:
+        self.repository = repository
+        self.backend = backend
+        self.max_age = max_age
+        self.limit = limit
+        self.crawl_batch = crawl_batch
+
+        self.hits = 0
+        self.misses = 0
+        self._terms: list[str] | None = None  # indexed vocabulary, reloaded after the index changed
+        self._refreshing: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+        # the crawl walks every two letter query, round after round
+        self._crawl_queries = itertools.cycle(a + b for a in string.ascii_lowercase for b in string.ascii_lowercase)
+
+    async def search(self, query: str) -> list[Manga]:
+        words = WORD.findall(query.lower())
+        if not words:
+            return []
+        results = await run_db(self._search_index, words)
+        if not results:
+            self.misses += 1
+            return await self.refresh(query)
+
+        self.hits += 1
+        if min(updated_at for _, updated_at in results) < time.time() - self.max_age:
+            self._refresh_later(query)
+        return [manga for manga, _ in results]
+
+    def _search_index(self, words: list[str]) -> list[tuple[Manga, float]]:
+        results = self.repository.search(match_expression(words), self.limit)
+        if results:
+            return results
+
+        terms = self._terms
+        if terms is None:
+            terms = self._terms = self.repository.find_terms()
+        corrected = []
+        for word in words:
+            close = difflib.get_close_matches(word, terms, n=1, cutoff=FUZZY_CUTOFF)
+            if close:
+                corrected.append(close[0])
+        if not corrected or corrected == words:
+            return []
+        return self.repository.search(match_expression(corrected), self.limit)
+
+    async def refresh(self, query: str) -> list[Manga]:
+        """Search the site live and index what it returns."""
+        mangas = await self.backend.get_queried_mangas(query)
+        if mangas:
+            await run_db(self.repository.save_mangas, mangas, time.time())
+            self._terms = None
+        return mangas
+
+    def _refresh_later(self, query: str) -> None:
+        key = query.lower()
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        task = asyncio.get_running_loop().create_task(self._background_refresh(query, key))
+        # keep a reference until it is done, the loop only holds weak ones
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _background_refresh(self, query: str, key: str) -> None:
+        try:
+            await self.refresh(query)
+        except Exception as e:
+            log.warning(f"Background refresh of catalog query {query!r} failed: {e}")
+        finally:
+            self._refreshing.discard(key)
+
+    async def crawl(self) -> None:
+        """One crawl round: index the subscribed mangas, refresh the stalest entries
+        and spend the rest of `crawl_batch` searches walking two letter queries."""
+        now = time.time()
+        await run_db(self.repository.seed_from_mangas, now)
+        stale = await run_db(self.repository.find_stale, now - self.max_age, self.crawl_batch)
+        queries = [manga.title for manga in stale]
+        queries += [next(self._crawl_queries) for _ in range(self.crawl_batch - len(queries))]
+
+        found_urls = set()
+        for query in queries:
+            try:
+                found_urls.update(manga.url for manga in await self.refresh(query))
+            except Exception as e:
+                log.warning(f"Catalog crawl query {query!r} failed: {e}")
+        # entries their own title no longer finds are not retried before max_age
+        gone = [manga for manga in stale if manga.url not in found_urls]
+        if gone:
+            await run_db(self.repository.save_mangas, gone, time.time())
+
+        size = await run_db(self.repository.count)
+        log.info(f"Catalog crawl ran {len(queries)} queries ({len(stale)} stale), {len(found_urls)} results, "
+                 f"{size} entries indexed, hits={self.hits} misses={self.misses}")
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# global catalog used by /add
+catalog = Catalog(
+    catalogRepo,
+    backend,
+    max_age=config.CATALOG_MAX_AGE,
+    limit=config.CATALOG_RESULTS,
+    crawl_batch=config.CATALOG_CRAWL_BATCH,
+)
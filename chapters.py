@@ -0,0 +1,52 @@
+import config
+import logger
+from backends import backend
+from cache import CacheEntry, chapter_cache
+from downloader import download_pdf
+from executors import run_db, run_download
+from jobs import DownloadJob, DownloadQueue, Priority, Ticket
+
+log = logger.get_logger(__name__)
+
+
+async def _build_chapter_pdf(job: DownloadJob) -> CacheEntry | None:
+    image_urls = await backend.get_chapter_image_urls(job.chapter_url)
+    if not image_urls:
+        return None
+    job.report(0, len(image_urls))
+
+    with await run_download(download_pdf, image_urls, job.report, job.cancelled) as pdf:
+        # a prefetch an interactive request joined is delivered right away, it is not prefetched anymore
+        prefetched = job.priority == Priority.PREFETCH
+        return await run_db(chapter_cache.put, job.chapter_url, pdf, job.filename, prefetched)
+
+
+# global download queue, every chapter build goes through it
+download_queue = DownloadQueue(
+    _build_chapter_pdf,
+    workers=config.DOWNLOAD_QUEUE_WORKERS,
+    max_queued=config.DOWNLOAD_QUEUE_SIZE,
+)
+
+
+def request_chapter_pdf(chapter_url: str, filename: str, user_id: int) -> Ticket:
+    """Queue the build of a chapter a user asked for. Raises QueueFullError.
+
+    Concurrent requests for the same chapter share a single build. Await the
+    result, a CacheEntry or None when the chapter has no images, with
+    `download_queue.wait`.
+    """
+    if chapter_url in download_queue:
+        log.info(f"Joining the build of {chapter_url} already queued or in progress")
+    return download_queue.submit(chapter_url, filename, Priority.INTERACTIVE, owner=user_id)
+
+
+async def prefetch_chapter_pdf(chapter_url: str, filename: str) -> CacheEntry | None:
+    """Build and cache the PDF of a chapter nobody asked for yet, unless it is already cached.
+
+    The build waits behind every interactive request, and a request for the
+    chapter arriving meanwhile joins it. Raises QueueFullError.
+    """
+    if await run_db(chapter_cache.contains, chapter_url):
+        return None
+    return await download_queue.wait(download_queue.submit(chapter_url, filename, Priority.PREFETCH))
@@ -0,0 +1,194 @@
+import os
+import sys
+import dotenv
+
+
+def resource_path(relative_path):
+    """Get absolute path to resource, works for dev and for PyInstaller"""
+    base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(sys.argv[0])))
+    return os.path.join(base_path, relative_path)
+
+
+# values already present in the environment win over the .env file
+dotenv.load_dotenv(resource_path(".env"))
+
+
+def _int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+def _float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+# ====== BROWSER POOL ======
+BROWSER_POOL_MIN_SIZE = _int("BROWSER_POOL_MIN_SIZE", 1)
+BROWSER_POOL_MAX_SIZE = _int("BROWSER_POOL_MAX_SIZE", 3)
+# a browser is recycled after serving this many pages...
+BROWSER_MAX_PAGES = _int("BROWSER_MAX_PAGES", 200)
+# ...or when firefox and its content processes use more than this (0 disables the check)
+BROWSER_MAX_MEMORY_MB = _int("BROWSER_MAX_MEMORY_MB", 1024)
+BROWSER_CHECKOUT_TIMEOUT = _float("BROWSER_CHECKOUT_TIMEOUT", 60)
+
+# ====== SCRAPING ======
+# base url of the scraped site, point it at fakesite.py to run without the live site
+WEEBCENTRAL_URL = os.getenv("WEEBCENTRAL_URL", "https://weebcentral.com/")
+# "http" reads pages with httpx + lxml and only falls back to a browser when needed, "selenium" always uses a browser
+SCRAPER_BACKEND = os.getenv("SCRAPER_BACKEND", "http")
+HTTP_MAX_CONNECTIONS = _int("HTTP_MAX_CONNECTIONS", 20)
+# page requests per second (and burst size) allowed against a single host
+HOST_RATE_LIMIT = _float("HOST_RATE_LIMIT", 5)
+HOST_RATE_BURST = _float("HOST_RATE_BURST", 10)
+
+# ====== ADAPTIVE CONCURRENCY ======
+# concurrent requests per host start at ADAPTIVE_INITIAL and move between ADAPTIVE_MIN and ADAPTIVE_MAX:
+# +1 per round of healthy responses, times ADAPTIVE_BACKOFF on 429/5xx/errors
+ADAPTIVE_INITIAL = _int("ADAPTIVE_INITIAL", 4)
+ADAPTIVE_MIN = _int("ADAPTIVE_MIN", 1)
+ADAPTIVE_MAX = _int("ADAPTIVE_MAX", 32)
+ADAPTIVE_BACKOFF = _float("ADAPTIVE_BACKOFF", 0.5)
+# a response this many times slower than the usual ones counts as a latency spike
+ADAPTIVE_LATENCY_FACTOR = _float("ADAPTIVE_LATENCY_FACTOR", 3)
+# failures in a row opening the circuit breaker of a host, and how long it fails fast before a probe
+BREAKER_FAILURES = _int("BREAKER_FAILURES", 5)
+BREAKER_OPEN_SECONDS = _float("BREAKER_OPEN_SECONDS", 30)
+# bounds of the selenium wait for the search results, scaled to the usual page latency
+SEARCH_WAIT_MIN = _float("SEARCH_WAIT_MIN", 2)
+SEARCH_WAIT_MAX = _float("SEARCH_WAIT_MAX", 15)
+
+# ====== LOOKUP CACHE ======
+# scraped search results and last chapters are reused for this many seconds
+SEARCH_CACHE_TTL = _int("SEARCH_CACHE_TTL", 3600)
+SEARCH_CACHE_SIZE = _int("SEARCH_CACHE_SIZE", 1000)
+LAST_CHAPTER_CACHE_TTL = _int("LAST_CHAPTER_CACHE_TTL", 900)
+LAST_CHAPTER_CACHE_SIZE = _int("LAST_CHAPTER_CACHE_SIZE", 5000)
+# 1 also keeps the entries in the database so they survive restarts
+LOOKUP_CACHE_PERSIST = _int("LOOKUP_CACHE_PERSIST", 0)
+
+# ====== CATALOG ======
+# /add answers from a local index of titles, entries older than this are refreshed
+CATALOG_MAX_AGE = _int("CATALOG_MAX_AGE", 7 * 86400)
+CATALOG_RESULTS = _int("CATALOG_RESULTS", 10)
+# live searches per crawl round, and seconds between rounds (0 disables the crawl)
+CATALOG_CRAWL_BATCH = _int("CATALOG_CRAWL_BATCH", 20)
+CATALOG_CRAWL_INTERVAL = _int("CATALOG_CRAWL_INTERVAL", 3600)
+
+# ====== NOTIFIER ======
+NOTIFIER_WORKERS = _int("NOTIFIER_WORKERS", 8)
+# how often the notifier job wakes up to check the mangas that are due
+NOTIFIER_TICK = _int("NOTIFIER_TICK", 300)
+# "digest" sends each user one message listing all their new chapters, "instant" one message per chapter
+NOTIFY_MODE = os.getenv("NOTIFY_MODE", "digest")
+# a digest is sent once its oldest chapter has waited this long (checked every NOTIFIER_TICK, 0 sends after every run)
+DIGEST_WINDOW = _int("DIGEST_WINDOW", 0)
+
+# ====== WORKERS ======
+# 1 leaves the manga checks to worker.py processes, the bot then only sends what they queue
+NOTIFIER_EXTERNAL = _int("NOTIFIER_EXTERNAL", 0)
+# the mangas are split in this many shards, each checked by the worker holding its lease
+NOTIFIER_SHARDS = _int("NOTIFIER_SHARDS", 64)
+# where the shard leases live, "sqlite" is the shared database.db of a single host
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "sqlite")
+# a lease not renewed for LEASE_TTL seconds is free for another worker, renewed every LEASE_HEARTBEAT
+LEASE_TTL = _int("LEASE_TTL", 60)
+LEASE_HEARTBEAT = _int("LEASE_HEARTBEAT", 15)
+
+# ====== WEBHOOK ======
+# public https url telegram posts updates to, empty uses long polling instead
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# where the embedded server listens, behind the TLS reverse proxy of WEBHOOK_URL
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = _int("WEBHOOK_PORT", 8443)
+# checked on every request, a random one is generated at startup when empty
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# updates processed at the same time, telegram is held back beyond that
+WEBHOOK_MAX_IN_FLIGHT = _int("WEBHOOK_MAX_IN_FLIGHT", 32)
+
+# ====== DISPATCH ======
+# telegram allows about 30 messages per second overall and one per second per chat
+DISPATCH_RATE = _float("DISPATCH_RATE", 30)
+DISPATCH_BURST = _int("DISPATCH_BURST", 30)
+DISPATCH_CHAT_INTERVAL = _float("DISPATCH_CHAT_INTERVAL", 1.0)
+# outbox messages read per round, and how long an idle dispatcher waits before looking again
+DISPATCH_BATCH_SIZE = _int("DISPATCH_BATCH_SIZE", 100)
+DISPATCH_IDLE_POLL = _float("DISPATCH_IDLE_POLL", 5.0)
+# a message failing this many times for a transient reason is dropped
+DISPATCH_MAX_ATTEMPTS = _int("DISPATCH_MAX_ATTEMPTS", 5)
+
+# ====== POLLING SCHEDULE (seconds) ======
+# polling pace inside a manga's expected release window
+POLL_MIN_INTERVAL = _int("POLL_MIN_INTERVAL", 900)
+# pace for mangas without a known cadence or with a late release
+POLL_DEFAULT_INTERVAL = _int("POLL_DEFAULT_INTERVAL", 3600)
+# upper bound of the dormant back-off
+POLL_MAX_INTERVAL = _int("POLL_MAX_INTERVAL", 3 * 86400)
+# half width of the release window, as a fraction of the cadence
+POLL_WINDOW_FRACTION = _float("POLL_WINDOW_FRACTION", 0.15)
+# a manga is dormant after this many cadences without a release...
+POLL_DORMANT_FACTOR = _float("POLL_DORMANT_FACTOR", 3)
+# ...or after this long when its cadence is unknown
+POLL_DORMANT_AFTER = _int("POLL_DORMANT_AFTER", 60 * 86400)
+
+# ====== DOWNLOADS ======
+# pages of one chapter downloaded in parallel
+DOWNLOAD_WORKERS = _int("DOWNLOAD_WORKERS", 8)
+DOWNLOAD_RETRIES = _int("DOWNLOAD_RETRIES", 3)
+# base delay of the jittered exponential back-off between retries
+DOWNLOAD_BACKOFF = _float("DOWNLOAD_BACKOFF", 0.5)
+DOWNLOAD_CONNECT_TIMEOUT = _float("DOWNLOAD_CONNECT_TIMEOUT", 10)
+DOWNLOAD_READ_TIMEOUT = _float("DOWNLOAD_READ_TIMEOUT", 30)
+# chapter builds waiting for a free download thread, more requests are turned away
+DOWNLOAD_QUEUE_SIZE = _int("DOWNLOAD_QUEUE_SIZE", 20)
+# minimum seconds between two edits of a download progress message
+DOWNLOAD_PROGRESS_INTERVAL = _float("DOWNLOAD_PROGRESS_INTERVAL", 3)
+
+# ====== IMAGE OPTIMIZATION ======
+# 1 recompresses the pages on a process pool before they go in the PDF
+OPTIMIZE_ENABLED = _int("OPTIMIZE_ENABLED", 0)
+OPTIMIZE_PROCESSES = _int("OPTIMIZE_PROCESSES", os.cpu_count() or 1)
+# wider pages are downscaled to this width, 0 keeps their size
+OPTIMIZE_MAX_WIDTH = _int("OPTIMIZE_MAX_WIDTH", 1200)
+OPTIMIZE_QUALITY = _int("OPTIMIZE_QUALITY", 80)
+# taller pages, like the long strips of webtoons, are sliced in several pages, 0 never slices
+OPTIMIZE_SLICE_HEIGHT = _int("OPTIMIZE_SLICE_HEIGHT", 4000)
+# the PDF is kept under this size by lowering the quality down to OPTIMIZE_MIN_QUALITY, then
+# the width, 0 disables it. Telegram bots can send documents of at most 50 MB
+OPTIMIZE_TARGET_MB = _float("OPTIMIZE_TARGET_MB", 0)
+OPTIMIZE_MIN_QUALITY = _int("OPTIMIZE_MIN_QUALITY", 40)
+
+# ====== CACHE ======
+CHAPTER_CACHE_DIR = os.getenv("CHAPTER_CACHE_DIR", os.path.join("cache", "chapters"))
+CHAPTER_CACHE_MAX_MB = _int("CHAPTER_CACHE_MAX_MB", 2048)
+# downloaded page images, reused by later builds of their chapter, 0 disables it
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", os.path.join("cache", "pages"))
+PAGE_CACHE_MAX_MB = _int("PAGE_CACHE_MAX_MB", 1024)
+# a cached page older than this is revalidated with the site (ETag / Last-Modified) before reuse
+PAGE_CACHE_REVALIDATE = _int("PAGE_CACHE_REVALIDATE", 86400)
+# 1 builds the PDF of new chapters as soon as they are detected
+PREFETCH_ENABLED = _int("PREFETCH_ENABLED", 0)
+PREFETCH_CONCURRENCY = _int("PREFETCH_CONCURRENCY", 1)
+# share of the chapter cache that prefetched PDFs nobody requested yet may take
+PREFETCH_MAX_MB = _int("PREFETCH_MAX_MB", 512)
+# only mangas with at least this many subscribers are prefetched
+PREFETCH_MIN_SUBSCRIBERS = _int("PREFETCH_MIN_SUBSCRIBERS", 2)
+
+# ====== OBSERVABILITY ======
+# "text" for human readable log lines, "json" for one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics, port 0 disables them
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _int("METRICS_PORT", 9464)
+
+# ====== EXECUTION ======
+# threads running blocking calls off the event loop, per category
+SCRAPE_THREADS = _int("SCRAPE_THREADS", BROWSER_POOL_MAX_SIZE)
+# chapters built at the same time, each downloading DOWNLOAD_WORKERS pages in parallel
+DOWNLOAD_THREADS = _int("DOWNLOAD_THREADS", 2)
+# workers of the download queue, one per download thread
+DOWNLOAD_QUEUE_WORKERS = _int("DOWNLOAD_QUEUE_WORKERS", DOWNLOAD_THREADS)
+# every thread gets its own sqlite connection, WAL lets them read while one writes
+DB_THREADS = _int("DB_THREADS", 4)
+# seconds a connection waits for another one to release its write lock before failing
+DB_BUSY_TIMEOUT = _float("DB_BUSY_TIMEOUT", 5)
+LOOP_LAG_INTERVAL = _float("LOOP_LAG_INTERVAL", 0.5)
+# log a warning when the event loop was blocked for longer than this
+LOOP_LAG_WARN = _float("LOOP_LAG_WARN", 0.25)
@@ -1,29 +1,122 @@
+import datetime
 import sqlite3
+import threading
+import time
+import weakref
+import config
 import logger
+from metrics import db_errors, db_seconds, timed
 from scraper import Chapter, Manga
 
 
 log = logger.get_logger(__name__)
 
-def get_connection() -> sqlite3.Connection:
-    return sqlite3.connect("database.db", check_same_thread=False)
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
 
 
-class MangaRepository:
+class _ThreadConnection:
+    """The connection of one thread, kept in its thread-local storage and released with it."""
+
     def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+
+
+class Database:
+    """Hands out one sqlite connection per thread, all tuned for concurrent access.
+
+    With WAL readers never block the writer and vice versa, so handlers
+    running on different threads no longer serialize on a shared connection.
+    The connection of a thread is closed when the thread exits, so short-lived
+    threads, like the page downloads of a chapter, do not leak them.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            connection = sqlite3.connect(self.path, timeout=config.DB_BUSY_TIMEOUT, check_same_thread=False)
+            for pragma in PRAGMAS:
+                connection.execute(pragma)
+            holder = _ThreadConnection(connection)
+            # runs once the thread exited and its thread-local storage was cleared
+            weakref.finalize(holder, self._release, connection)
+            self._local.holder = holder
+            with self._lock:
+                self._connections.append(connection)
+        return holder.connection
+
+    def _release(self, connection: sqlite3.Connection) -> None:
+        with self._lock:
+            if connection not in self._connections:
+                # already closed by close()
+                return
+            self._connections.remove(connection)
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+
+def get_database() -> Database:
+    return Database("database.db")
+
+
+class Repository:
+    """Base of the repositories, giving each calling thread its own connection.
+
+    Every public method of a repository is timed in the db_seconds histogram.
+    """
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        for name, attribute in list(vars(cls).items()):
+            if callable(attribute) and not name.startswith("_"):
+                setattr(cls, name, timed(db_seconds, db_errors, method=f"{cls.__name__}.{name}")(attribute))
+
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        return self.database.connection()
+
+
+class MangaRepository(Repository):
+    def __init__(self, database: Database) -> None:
         try:
-            self.connection = connection
-            self.cursor = self.connection.cursor()
+            self.database = database
+            cursor = self.connection.cursor()
 
             # table
-            self.cursor.execute("""
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS chapters (    
                     url TEXT PRIMARY KEY,
                     title TEXT NOT NULL,
                     published_at TEXT NOT NULL
                 )       
             """)
-            self.cursor.execute("""
+            # telegram file_id of every chapter PDF already uploaded, so it can be resent without uploading
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chapter_files (
+                    chapter_url TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL
+                )
+            """)
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS mangas (
                     url TEXT PRIMARY KEY,
                     title TEXT NOT NULL,
@@ -31,45 +124,78 @@ class MangaRepository:
                     FOREIGN KEY (last_chapter_url) REFERENCES chapters(url)
                 )
             """)
-            self.cursor.execute("""
+            # release history of every manga, used to learn its cadence
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS manga_chapters (
+                    manga_url TEXT NOT NULL,
+                    chapter_url TEXT NOT NULL,
+                    published_at TEXT NOT NULL,
+                    PRIMARY KEY (manga_url, chapter_url),
+                    FOREIGN KEY (manga_url) REFERENCES mangas(url)
+                )
+            """)
+            # mangas saved before the history existed start with their last chapter
+            cursor.execute("""
+                INSERT OR IGNORE INTO manga_chapters (manga_url, chapter_url, published_at)
+                SELECT m.url, c.url, c.published_at
+                FROM mangas m
+                JOIN chapters c ON m.last_chapter_url = c.url
+            """)
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS user_mangas (
-                    user_id INTEGER,
-                    manga_url TEXT,
+                    user_id INTEGER NOT NULL,
+                    manga_url TEXT NOT NULL,
+                    PRIMARY KEY (user_id, manga_url),
                     FOREIGN KEY (user_id) REFERENCES users(user_id),
                     FOREIGN KEY (manga_url) REFERENCES mangas(url)
-                )
+                ) WITHOUT ROWID
             """)
             self.connection.commit()
+            self._migrate_user_mangas(cursor)
+            # subscribers of a manga, the primary key already covers lookups by user
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_mangas_manga_url ON user_mangas (manga_url, user_id)")
+            self.connection.commit()
             log.info("Database initialized successfully.")
         except sqlite3.Error as e:
             log.exception(f"Database error: {e}")
             raise
     
+    def _migrate_user_mangas(self, cursor: sqlite3.Cursor) -> None:
+        """Rebuild a user_mangas table created before it had a primary key, dropping duplicates."""
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_mangas'")
+        if "PRIMARY KEY" in cursor.fetchone()[0]:
+            return
+        log.info("Migrating user_mangas to a (user_id, manga_url) primary key.")
+        cursor.executescript("""
+            BEGIN;
+            CREATE TABLE user_mangas_new (
+                user_id INTEGER NOT NULL,
+                manga_url TEXT NOT NULL,
+                PRIMARY KEY (user_id, manga_url),
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (manga_url) REFERENCES mangas(url)
+            ) WITHOUT ROWID;
+            INSERT OR IGNORE INTO user_mangas_new (user_id, manga_url)
+            SELECT user_id, manga_url FROM user_mangas WHERE user_id IS NOT NULL AND manga_url IS NOT NULL;
+            DROP TABLE user_mangas;
+            ALTER TABLE user_mangas_new RENAME TO user_mangas;
+            COMMIT;
+        """)
+
     def save_manga(self, user_id: int, manga: Manga) -> None:
-        """Save a manga to the database, along with its last chapter."""
-        try:
-            # check if manga already exist
-            self.cursor.execute("SELECT * FROM mangas WHERE url = ?", (manga.url,)) # must be a tuple
-            if self.cursor.fetchone():
-                log.info(f"Manga {manga.title} already exists in the database.")
-                # check if the manga is already associated with the user
-                self.cursor.execute("SELECT * FROM user_mangas WHERE user_id = ? AND manga_url = ?", (user_id, manga.url))
-                if self.cursor.fetchone():
-                    log.info(f"Manga {manga.title} is already associated with user_id {user_id}. Doing nothing.")
-                    return
-                # add the manga to user_mangas
-                self.cursor.execute("INSERT INTO user_mangas (user_id, manga_url) VALUES (?, ?)", (user_id, manga.url))
-                log.info(f"Manga {manga.title} added to user_mangas for chat_id {user_id}.")
-                return
-            
-            
-            
-            # manga is new in the database, save the manga, its last chapter, and associate it with the user
-            self.cursor.execute("INSERT INTO mangas (url, title, last_chapter_url) VALUES (?, ?, ?)", 
-                                (manga.url, manga.title, manga.last_chapter.url))
-            self.cursor.execute("INSERT INTO chapters (url, title, published_at) VALUES (?, ?, ?)", 
-                                (manga.last_chapter.url, manga.last_chapter.title, manga.last_chapter.published_at))
-            self.cursor.execute("INSERT INTO user_mangas (user_id, manga_url) VALUES (?, ?)", (user_id, manga.url))
+        """Save a manga to the database, along with its last chapter, and subscribe the user to it.
+
+        A manga that is already known keeps its stored last chapter.
+        """
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT INTO chapters (url, title, published_at) VALUES (?, ?, ?) ON CONFLICT (url) DO NOTHING",
+                           (manga.last_chapter.url, manga.last_chapter.title, manga.last_chapter.published_at))
+            cursor.execute("INSERT INTO mangas (url, title, last_chapter_url) VALUES (?, ?, ?) ON CONFLICT (url) DO NOTHING",
+                           (manga.url, manga.title, manga.last_chapter.url))
+            cursor.execute("INSERT OR IGNORE INTO manga_chapters (manga_url, chapter_url, published_at) VALUES (?, ?, ?)",
+                           (manga.url, manga.last_chapter.url, manga.last_chapter.published_at))
+            cursor.execute("INSERT OR IGNORE INTO user_mangas (user_id, manga_url) VALUES (?, ?)", (user_id, manga.url))
             self.connection.commit()
             log.info(f"Manga {manga.title} saved to the database and associated with chat_id {user_id}.")
 
@@ -81,14 +207,15 @@ class MangaRepository:
     def find_all_mangas_by_chat_id(self, user_id: int) -> list[Manga]:
         # load all mangas associated with a chat_id
         try:
-            self.cursor.execute("""
+            cursor = self.connection.cursor()
+            cursor.execute("""
                 SELECT m.url, m.title, c.url, c.title, c.published_at 
                 FROM user_mangas um
                 JOIN mangas m ON um.manga_url = m.url
                 JOIN chapters c ON m.last_chapter_url = c.url
                 WHERE um.user_id = ?
             """, (user_id,))
-            rows = self.cursor.fetchall()
+            rows = cursor.fetchall()
             mangas = [
                 Manga(
                     url=row[0],
@@ -110,12 +237,13 @@ class MangaRepository:
     def find_all_mangas(self) -> list[Manga]:
         """Find all mangas in the database."""
         try:
-            self.cursor.execute("""
+            cursor = self.connection.cursor()
+            cursor.execute("""
                 SELECT m.url, m.title, c.url, c.title, c.published_at 
                 FROM mangas m
                 JOIN chapters c ON m.last_chapter_url = c.url
             """)
-            rows = self.cursor.fetchall()
+            rows = cursor.fetchall()
             mangas = [
                 Manga(
                     url=row[0],
@@ -137,13 +265,14 @@ class MangaRepository:
     def find_manga_by_chapter_url(self, chapter_url: str) -> Manga | None:
         """Find a manga by its chapter URL."""
         try:
-            self.cursor.execute("""
+            cursor = self.connection.cursor()
+            cursor.execute("""
                 SELECT m.url, m.title, c.url, c.title, c.published_at 
                 FROM mangas m
                 JOIN chapters c ON m.last_chapter_url = c.url
                 WHERE c.url = ?
             """, (chapter_url,))
-            row = self.cursor.fetchone()
+            row = cursor.fetchone()
             if row:
                 return Manga(
                     url=row[0],
@@ -158,12 +287,54 @@ class MangaRepository:
         except sqlite3.Error as e:
             log.exception(f"Error finding manga by chapter URL {chapter_url}: {e}")
             raise
-class UserRepository:
-    def __init__(self, connection: sqlite3.Connection) -> None:
+
+    def find_chapter_urls(self, manga_url: str) -> set[str]:
+        """Find the URLs of every chapter in the history of a manga."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT chapter_url FROM manga_chapters WHERE manga_url = ?", (manga_url,))
+            return {row[0] for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            log.exception(f"Error finding chapters of manga {manga_url}: {e}")
+            raise
+
+    def save_chapters(self, manga_url: str, chapters: list[Chapter], last_chapter: Chapter | None) -> None:
+        """Add chapters to the history of a manga in one transaction, moving its last chapter to `last_chapter`."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO chapters (url, title, published_at) VALUES (?, ?, ?)",
+                               [(chapter.url, chapter.title, chapter.published_at) for chapter in chapters])
+            cursor.executemany("INSERT OR IGNORE INTO manga_chapters (manga_url, chapter_url, published_at) VALUES (?, ?, ?)",
+                               [(manga_url, chapter.url, chapter.published_at) for chapter in chapters])
+            if last_chapter:
+                cursor.execute("UPDATE mangas SET last_chapter_url = ? WHERE url = ?", (last_chapter.url, manga_url))
+            self.connection.commit()
+            log.info(f"Saved {len(chapters)} chapters of manga {manga_url}.")
+        except sqlite3.Error as e:
+            log.exception(f"Error saving chapters of manga {manga_url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def find_release_history(self) -> dict[str, list[datetime.datetime]]:
+        """Find the publication dates of the known chapters of every manga, oldest first."""
         try:
-            self.connection = connection
-            self.cursor = self.connection.cursor()
-            self.cursor.execute("""
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT manga_url, published_at FROM manga_chapters ORDER BY published_at")
+            history: dict[str, list[datetime.datetime]] = {}
+            for manga_url, published_at in cursor.fetchall():
+                history.setdefault(manga_url, []).append(datetime.datetime.fromisoformat(published_at))
+            return history
+        except sqlite3.Error as e:
+            log.exception(f"Error finding release history: {e}")
+            raise
+
+
+class UserRepository(Repository):
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY
                 )
@@ -177,7 +348,8 @@ class UserRepository:
     def save_user(self, user_id: int) -> None:
         """Save a user to the database."""
         try:
-            self.cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
             self.connection.commit()
             log.info(f"User with user_id {user_id} saved to the database.")
         except sqlite3.Error as e:
@@ -188,19 +360,31 @@ class UserRepository:
     def find_all_user_ids(self) -> list[int]:
         """Find all user IDs in the database."""
         try:
-            self.cursor.execute("SELECT user_id FROM users")
-            rows = self.cursor.fetchall()
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT user_id FROM users")
+            rows = cursor.fetchall()
             user_ids = [row[0] for row in rows]
             log.info(f"Found {len(user_ids)} user IDs in the database.")
             return user_ids
         except sqlite3.Error as e:
             log.exception(f"Error finding user IDs: {e}")
             raise
+    def count_users_by_manga_url(self, manga_url: str) -> int:
+        """Count the subscribers of a manga."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM user_mangas WHERE manga_url = ?", (manga_url,))
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error counting users of manga URL {manga_url}: {e}")
+            raise
+
     def find_user_ids_by_manga_url(self, manga_url: str) -> list[int]:
         """Find all user IDs associated with a manga URL."""
         try:
-            self.cursor.execute("SELECT user_id FROM user_mangas WHERE manga_url = ?", (manga_url,))
-            rows = self.cursor.fetchall()
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT user_id FROM user_mangas WHERE manga_url = ?", (manga_url,))
+            rows = cursor.fetchall()
             user_ids = [row[0] for row in rows]
             log.info(f"Found {len(user_ids)} user IDs for manga URL {manga_url}.")
             return user_ids
@@ -211,7 +395,8 @@ class UserRepository:
     def delete_manga_of_user(self, user_id: int, manga_url: str) -> None:
         """Delete a manga of a user from the database."""
         try:
-            self.cursor.execute("DELETE FROM user_mangas WHERE user_id = ? AND manga_url = ?", (user_id, manga_url))
+            cursor = self.connection.cursor()
+            cursor.execute("DELETE FROM user_mangas WHERE user_id = ? AND manga_url = ?", (user_id, manga_url))
             self.connection.commit()
             log.info(f"Manga deleted for user_id {user_id}.")
         except sqlite3.Error as e:
@@ -219,16 +404,13 @@ class UserRepository:
             self.connection.rollback()
             raise
 
-class ChapterRepository:
-    def __init__(self, connection: sqlite3.Connection) -> None:
-        self.connection = connection
-        self.cursor = self.connection.cursor()
-    
+class ChapterRepository(Repository):
     def find_chapter(self, chapter_url: str) -> Chapter | None:
         """Find a chapter by its URL."""
         try:
-            self.cursor.execute("SELECT * FROM chapters WHERE url = ?", (chapter_url,))
-            row = self.cursor.fetchone()
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT * FROM chapters WHERE url = ?", (chapter_url,))
+            row = cursor.fetchone()
             if row:
                 return Chapter(
                     url=row[0],
@@ -239,4 +421,660 @@ class ChapterRepository:
         except sqlite3.Error as e:
             log.exception(f"Error finding chapter with URL {chapter_url}: {e}")
             raise
-        
\ No newline at end of file
+
+    def find_file_id(self, chapter_url: str) -> str | None:
+        """Find the telegram file_id of an already uploaded chapter PDF."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT file_id FROM chapter_files WHERE chapter_url = ?", (chapter_url,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            log.exception(f"Error finding file_id of chapter {chapter_url}: {e}")
+            raise
+
+    def save_file_id(self, chapter_url: str, file_id: str) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR REPLACE INTO chapter_files (chapter_url, file_id) VALUES (?, ?)", (chapter_url, file_id))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error saving file_id of chapter {chapter_url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def delete_file_id(self, chapter_url: str) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("DELETE FROM chapter_files WHERE chapter_url = ?", (chapter_url,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error deleting file_id of chapter {chapter_url}: {e}")
+            self.connection.rollback()
+            raise
+
+
+class ChapterCacheRepository(Repository):
+    """Index of the chapter PDFs cached on disk, kept in the database so it survives restarts."""
+
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chapter_cache (
+                    chapter_url TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL,
+                    prefetched INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # 1 while a prefetched PDF has not been requested by anyone yet
+            cursor.execute("PRAGMA table_info(chapter_cache)")
+            if "prefetched" not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute("ALTER TABLE chapter_cache ADD COLUMN prefetched INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chapter_cache_last_access ON chapter_cache (last_access)")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def find_entry(self, chapter_url: str) -> tuple[str, str, int] | None:
+        """Find the path, filename and size of a cached chapter."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT path, filename, size FROM chapter_cache WHERE chapter_url = ?", (chapter_url,))
+            return cursor.fetchone()
+        except sqlite3.Error as e:
+            log.exception(f"Error finding cache entry for {chapter_url}: {e}")
+            raise
+
+    def save_entry(self, chapter_url: str, path: str, filename: str, size: int, last_access: float,
+                   prefetched: bool = False) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                INSERT INTO chapter_cache (chapter_url, path, filename, size, last_access, prefetched)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chapter_url) DO UPDATE SET
+                    path = excluded.path, filename = excluded.filename, size = excluded.size,
+                    last_access = excluded.last_access, prefetched = excluded.prefetched
+            """, (chapter_url, path, filename, size, last_access, int(prefetched)))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error saving cache entry for {chapter_url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def touch_entry(self, chapter_url: str, last_access: float) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("UPDATE chapter_cache SET last_access = ?, prefetched = 0 WHERE chapter_url = ?",
+                           (last_access, chapter_url))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error updating cache entry for {chapter_url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def delete_entry(self, chapter_url: str) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("DELETE FROM chapter_cache WHERE chapter_url = ?", (chapter_url,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error deleting cache entry for {chapter_url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def total_size(self) -> int:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM chapter_cache")
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error computing cache size: {e}")
+            raise
+
+    def prefetched_size(self) -> int:
+        """Bytes taken by prefetched PDFs nobody requested yet."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM chapter_cache WHERE prefetched = 1")
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error computing prefetched cache size: {e}")
+            raise
+
+    def find_least_recent(self, limit: int) -> list[tuple[str, str, int]]:
+        """Find the url, path and size of the least recently used cached chapters."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT chapter_url, path, size FROM chapter_cache ORDER BY last_access LIMIT ?", (limit,))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            log.exception(f"Error finding least recently used cache entries: {e}")
+            raise
+
+
+class PageCacheRepository(Repository):
+    """Index of the chapter page images cached on disk, each stored once per content hash."""
+
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS page_cache (
+                    url TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    validated_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_page_cache_last_access ON page_cache (last_access)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_page_cache_hash ON page_cache (hash)")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def find_entry(self, url: str) -> tuple[str, int, str | None, str | None, float] | None:
+        """Find the hash, size, etag, last_modified and validated_at of a cached page."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT hash, size, etag, last_modified, validated_at FROM page_cache WHERE url = ?", (url,))
+            return cursor.fetchone()
+        except sqlite3.Error as e:
+            log.exception(f"Error finding cached page {url}: {e}")
+            raise
+
+    def save_entry(self, url: str, content_hash: str, size: int, etag: str | None, last_modified: str | None,
+                   now: float) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO page_cache (url, hash, size, etag, last_modified, validated_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (url, content_hash, size, etag, last_modified, now, now))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error saving cached page {url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def touch_entry(self, url: str, now: float, validated: bool = False) -> None:
+        try:
+            cursor = self.connection.cursor()
+            if validated:
+                cursor.execute("UPDATE page_cache SET last_access = ?, validated_at = ? WHERE url = ?", (now, now, url))
+            else:
+                cursor.execute("UPDATE page_cache SET last_access = ? WHERE url = ?", (now, url))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error updating cached page {url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def delete_entry(self, url: str) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("DELETE FROM page_cache WHERE url = ?", (url,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error deleting cached page {url}: {e}")
+            self.connection.rollback()
+            raise
+
+    def count_hash(self, content_hash: str) -> int:
+        """Number of cached urls whose content is stored under `content_hash`."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM page_cache WHERE hash = ?", (content_hash,))
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error counting cached pages of {content_hash}: {e}")
+            raise
+
+    def total_size(self) -> int:
+        """Bytes on disk, every distinct content counted once."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM page_cache GROUP BY hash)")
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error computing page cache size: {e}")
+            raise
+
+    def find_least_recent(self, limit: int) -> list[tuple[str, str, int]]:
+        """Find the url, hash and size of the least recently used cached pages."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT url, hash, size FROM page_cache ORDER BY last_access LIMIT ?", (limit,))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            log.exception(f"Error finding least recently used cached pages: {e}")
+            raise
+
+
+class OutboxRepository(Repository):
+    """Durable queue of telegram messages waiting to be sent, so they survive restarts."""
+
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    document TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    not_before REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_not_before ON outbox (not_before, id)")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def enqueue(self, messages: list[tuple[int, str, str | None]], not_before: float) -> None:
+        """Queue (chat_id, text, document file_id or None) messages in one transaction."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("INSERT INTO outbox (chat_id, text, document, not_before) VALUES (?, ?, ?, ?)",
+                               [(chat_id, text, document, not_before) for chat_id, text, document in messages])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error queueing {len(messages)} messages: {e}")
+            self.connection.rollback()
+            raise
+
+    def enqueue_digests(self, messages: list[tuple[int, str, str | None]], items: list[tuple[int, str]],
+                        not_before: float) -> None:
+        """Queue digest messages and delete their (user_id, chapter_url) digest items in one transaction,
+        so a digest is never queued twice."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("INSERT INTO outbox (chat_id, text, document, not_before) VALUES (?, ?, ?, ?)",
+                               [(chat_id, text, document, not_before) for chat_id, text, document in messages])
+            cursor.executemany("DELETE FROM digest_items WHERE user_id = ? AND chapter_url = ?", items)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error queueing {len(messages)} digest messages: {e}")
+            self.connection.rollback()
+            raise
+
+    def find_ready(self, now: float, limit: int) -> list[tuple[int, int, str, str | None, int]]:
+        """Find the id, chat_id, text, document and attempts of the oldest messages ready to be sent."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT id, chat_id, text, document, attempts FROM outbox
+                WHERE not_before <= ?
+                ORDER BY not_before, id
+                LIMIT ?
+            """, (now, limit))
+            return cursor.fetchall()
+        except sqlite3.Error as e:
+            log.exception(f"Error finding outbox messages: {e}")
+            raise
+
+    def delete(self, message_ids: list[int]) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("DELETE FROM outbox WHERE id = ?", [(message_id,) for message_id in message_ids])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error deleting outbox messages: {e}")
+            self.connection.rollback()
+            raise
+
+    def reschedule(self, messages: list[tuple[int, float, int]]) -> None:
+        """Set the not_before and attempts of (id, not_before, attempts) messages."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("UPDATE outbox SET not_before = ?, attempts = ? WHERE id = ?",
+                               [(not_before, attempts, message_id) for message_id, not_before, attempts in messages])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error rescheduling outbox messages: {e}")
+            self.connection.rollback()
+            raise
+
+    def count(self) -> int:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM outbox")
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error counting outbox messages: {e}")
+            raise
+
+
+class DigestRepository(Repository):
+    """New chapters waiting to be sent to their subscribers as one digest message per user."""
+
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS digest_items (
+                    user_id INTEGER NOT NULL,
+                    chapter_url TEXT NOT NULL,
+                    manga_url TEXT NOT NULL,
+                    found_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, chapter_url)
+                ) WITHOUT ROWID
+            """)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def add_chapters(self, manga_url: str, chapter_urls: list[str], found_at: float) -> None:
+        """Add chapters of a manga to the pending digest of every user subscribed to it."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("""
+                INSERT OR IGNORE INTO digest_items (user_id, chapter_url, manga_url, found_at)
+                SELECT um.user_id, ?, um.manga_url, ?
+                FROM user_mangas um
+                WHERE um.manga_url = ?
+            """, [(chapter_url, found_at, manga_url) for chapter_url in chapter_urls])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error adding chapters of manga {manga_url} to the digests: {e}")
+            self.connection.rollback()
+            raise
+
+    def find_due(self, older_than: float) -> dict[int, list[tuple[str, str, str]]]:
+        """Find the (manga title, chapter title, chapter url) items of every user whose oldest
+        pending item was found before `older_than`, grouped by manga in publication order."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT d.user_id, m.title, c.title, c.url
+                FROM digest_items d
+                JOIN mangas m ON d.manga_url = m.url
+                JOIN chapters c ON d.chapter_url = c.url
+                WHERE d.user_id IN (
+                    SELECT user_id FROM digest_items GROUP BY user_id HAVING MIN(found_at) <= ?
+                )
+                ORDER BY d.user_id, m.title, c.published_at
+            """, (older_than,))
+            digests: dict[int, list[tuple[str, str, str]]] = {}
+            for user_id, manga_title, chapter_title, chapter_url in cursor.fetchall():
+                digests.setdefault(user_id, []).append((manga_title, chapter_title, chapter_url))
+            return digests
+        except sqlite3.Error as e:
+            log.exception(f"Error finding due digests: {e}")
+            raise
+
+
+class CatalogRepository(Repository):
+    """Local index of the site's manga titles, searched with FTS5 instead of scraping."""
+
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS catalog (
+                    url TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_catalog_updated_at ON catalog (updated_at)")
+            # external content index over catalog.title, prefix indexes make "term"* queries cheap
+            cursor.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+                    title, content='catalog', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                )
+            """)
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS catalog_terms USING fts5vocab(catalog_fts, 'row')")
+            cursor.executescript("""
+                CREATE TRIGGER IF NOT EXISTS catalog_ai AFTER INSERT ON catalog BEGIN
+                    INSERT INTO catalog_fts (rowid, title) VALUES (new.rowid, new.title);
+                END;
+                CREATE TRIGGER IF NOT EXISTS catalog_ad AFTER DELETE ON catalog BEGIN
+                    INSERT INTO catalog_fts (catalog_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+                END;
+                CREATE TRIGGER IF NOT EXISTS catalog_au AFTER UPDATE OF title ON catalog BEGIN
+                    INSERT INTO catalog_fts (catalog_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+                    INSERT INTO catalog_fts (rowid, title) VALUES (new.rowid, new.title);
+                END;
+            """)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def save_mangas(self, mangas: list[Manga], updated_at: float) -> None:
+        """Add or refresh catalog entries in one transaction."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("""
+                INSERT INTO catalog (url, title, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at
+            """, [(manga.url, manga.title, updated_at) for manga in mangas])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error saving {len(mangas)} catalog entries: {e}")
+            self.connection.rollback()
+            raise
+
+    def seed_from_mangas(self, updated_at: float) -> None:
+        """Add the mangas users subscribed to, without touching entries already indexed."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR IGNORE INTO catalog (url, title, updated_at) SELECT url, title, ? FROM mangas",
+                           (updated_at,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error seeding the catalog: {e}")
+            self.connection.rollback()
+            raise
+
+    def search(self, match: str, limit: int) -> list[tuple[Manga, float]]:
+        """Find the best ranked entries for an FTS5 MATCH expression, with their updated_at."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                SELECT c.url, c.title, c.updated_at
+                FROM catalog_fts f
+                JOIN catalog c ON c.rowid = f.rowid
+                WHERE catalog_fts MATCH ?
+                ORDER BY f.rank
+                LIMIT ?
+            """, (match, limit))
+            return [(Manga(title=title, url=url), updated_at) for url, title, updated_at in cursor.fetchall()]
+        except sqlite3.Error as e:
+            log.exception(f"Error searching the catalog for {match!r}: {e}")
+            raise
+
+    def find_terms(self) -> list[str]:
+        """Every distinct word of the indexed titles."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT term FROM catalog_terms")
+            return [row[0] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            log.exception(f"Error finding catalog terms: {e}")
+            raise
+
+    def find_stale(self, older_than: float, limit: int) -> list[Manga]:
+        """Entries last refreshed before `older_than`, least recently refreshed first."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT url, title FROM catalog WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+                           (older_than, limit))
+            return [Manga(title=title, url=url) for url, title in cursor.fetchall()]
+        except sqlite3.Error as e:
+            log.exception(f"Error finding stale catalog entries: {e}")
+            raise
+
+    def count(self) -> int:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM catalog")
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error counting catalog entries: {e}")
+            raise
+
+
+class LookupCacheRepository(Repository):
+    """Persisted entries of the scraping lookup caches, so they survive restarts."""
+
+    def __init__(self, database: Database) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS lookup_cache (
+                    cache TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (cache, key)
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("DELETE FROM lookup_cache WHERE expires_at < ?", (time.time(),))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def find_value(self, cache: str, key: str, now: float) -> str | None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT value FROM lookup_cache WHERE cache = ? AND key = ? AND expires_at > ?",
+                           (cache, key, now))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            log.exception(f"Error finding {cache} cache entry {key}: {e}")
+            raise
+
+    def save_value(self, cache: str, key: str, value: str, expires_at: float) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR REPLACE INTO lookup_cache (cache, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                           (cache, key, value, expires_at))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error saving {cache} cache entry {key}: {e}")
+            self.connection.rollback()
+            raise
+
+
+class LeaseRepository(Repository):
+    """Leases on the shards of the mangas table, held by the worker processes checking them."""
+
+    def __init__(self, database: Database, shards: int) -> None:
+        try:
+            self.database = database
+            cursor = self.connection.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    owner TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS shard_leases (
+                    shard INTEGER PRIMARY KEY,
+                    owner TEXT,
+                    expires_at REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # the shard count may change between runs, leases of shards that no longer exist are dropped
+            cursor.execute("DELETE FROM shard_leases WHERE shard >= ?", (shards,))
+            cursor.executemany("INSERT OR IGNORE INTO shard_leases (shard) VALUES (?)", [(shard,) for shard in range(shards)])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Database error: {e}")
+            raise
+
+    def heartbeat(self, owner: str, now: float, ttl: float) -> list[int]:
+        """Mark a worker alive and renew its leases, returning the shards it still holds."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("INSERT OR REPLACE INTO workers (owner, expires_at) VALUES (?, ?)", (owner, now + ttl))
+            # a lease that already expired may have been taken over, it is not renewed
+            cursor.execute("UPDATE shard_leases SET expires_at = ? WHERE owner = ? AND expires_at >= ?",
+                           (now + ttl, owner, now))
+            cursor.execute("DELETE FROM workers WHERE expires_at < ?", (now,))
+            cursor.execute("SELECT shard FROM shard_leases WHERE owner = ? AND expires_at >= ? ORDER BY shard",
+                           (owner, now))
+            shards = [row[0] for row in cursor.fetchall()]
+            self.connection.commit()
+            return shards
+        except sqlite3.Error as e:
+            log.exception(f"Error renewing the leases of {owner}: {e}")
+            self.connection.rollback()
+            raise
+
+    def count_workers(self, now: float) -> int:
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM workers WHERE expires_at >= ?", (now,))
+            return cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.exception(f"Error counting workers: {e}")
+            raise
+
+    def acquire(self, owner: str, count: int, now: float, ttl: float) -> list[int]:
+        """Take up to `count` free or expired shards, returning the ones taken."""
+        try:
+            cursor = self.connection.cursor()
+            # the write lock is taken up front, so two workers never pick the same free shards
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT shard FROM shard_leases
+                WHERE owner IS NULL OR expires_at < ?
+                ORDER BY expires_at, shard
+                LIMIT ?
+            """, (now, count))
+            shards = [row[0] for row in cursor.fetchall()]
+            cursor.executemany("UPDATE shard_leases SET owner = ?, expires_at = ? WHERE shard = ?",
+                               [(owner, now + ttl, shard) for shard in shards])
+            self.connection.commit()
+            return shards
+        except sqlite3.Error as e:
+            log.exception(f"Error acquiring shards for {owner}: {e}")
+            self.connection.rollback()
+            raise
+
+    def release(self, owner: str, shards: list[int]) -> None:
+        try:
+            cursor = self.connection.cursor()
+            cursor.executemany("UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE shard = ? AND owner = ?",
+                               [(shard, owner) for shard in shards])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error releasing shards of {owner}: {e}")
+            self.connection.rollback()
+            raise
+
+    def leave(self, owner: str) -> None:
+        """Release every lease of a worker that stops, so the others take over right away."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE owner = ?", (owner,))
+            cursor.execute("DELETE FROM workers WHERE owner = ?", (owner,))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.exception(f"Error removing worker {owner}: {e}")
+            self.connection.rollback()
+            raise
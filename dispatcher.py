@@ -0,0 +1,182 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+import config
+import logger
+from db import OutboxRepository
+from executors import run_db
+from ratelimit import TokenBucket
+from repo import outboxRepo
+
+log = logger.get_logger(__name__)
+
+
+@dataclass
+class OutboxMessage:
+    chat_id: int
+    text: str
+    document: str | None = None  # file_id of an uploaded document, `text` becomes its caption
+
+
+class Dispatcher:
+    """Sends queued telegram messages within the Bot API rate limits.
+
+    Messages are written to the outbox table before anything is sent, so a
+    restart resumes where the last run stopped. A single drain task reads the
+    outbox oldest first and sends through a global token bucket, keeping
+    `chat_interval` between two messages to the same chat. A RetryAfter pauses
+    every send for as long as telegram asks instead of letting the rest of the
+    batch run into the same 429.
+    """
+
+    def __init__(self, repository: OutboxRepository, rate: float, burst: float, chat_interval: float,
+                 batch_size: int, idle_poll: float, max_attempts: int) -> None:
+        self.repository = repository
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_interval = chat_interval
+        self.batch_size = batch_size
+        self.idle_poll = idle_poll
+        self.max_attempts = max_attempts
+
+        self.sent = 0
+        self.dropped = 0
+        # earliest time (epoch) the next message to a chat may go out
+        self._chat_ready: dict[int, float] = {}
+        self._paused_until = 0.0  # monotonic
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def enqueue(self, messages: list[OutboxMessage]) -> None:
+        if not messages:
+            return
+        rows = [(message.chat_id, message.text, message.document) for message in messages]
+        await run_db(self.repository.enqueue, rows, time.time())
+        self._wakeup.set()
+
+    async def enqueue_digests(self, messages: list[OutboxMessage], items: list[tuple[int, str]]) -> None:
+        """Queue digest messages, deleting the (user_id, chapter_url) digest items they cover at once."""
+        rows = [(message.chat_id, message.text, message.document) for message in messages]
+        await run_db(self.repository.enqueue_digests, rows, items, time.time())
+        self._wakeup.set()
+
+    def start(self, bot: Bot) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(bot))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot: Bot) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                processed, next_ready = await self._drain(bot)
+            except Exception as e:
+                log.exception(f"Dispatcher round failed: {e}")
+                processed, next_ready = 0, None
+            if processed:
+                continue
+
+            timeout = self.idle_poll
+            if next_ready is not None:
+                timeout = min(timeout, max(0.0, next_ready - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    async def _drain(self, bot: Bot) -> tuple[int, float | None]:
+        """Send one batch of ready messages. Returns how many were sent or dropped and
+        the earliest time a message deferred for its chat's pacing or retried becomes ready."""
+        now = time.time()
+        rows = await run_db(self.repository.find_ready, now, self.batch_size)
+        if not rows:
+            return 0, None
+
+        if len(self._chat_ready) > 10 * self.batch_size:
+            self._chat_ready = {chat_id: ready for chat_id, ready in self._chat_ready.items() if ready > now}
+
+        sends, deferred = [], []
+        for message_id, chat_id, text, document, attempts in rows:
+            ready = self._chat_ready.get(chat_id, 0.0)
+            if ready > now:
+                deferred.append((message_id, ready, attempts))
+            else:
+                self._chat_ready[chat_id] = now + self.chat_interval
+                sends.append(self._send(bot, message_id, chat_id, text, document, attempts))
+
+        results = await asyncio.gather(*sends)
+        done = [result for result in results if isinstance(result, int)]
+        retries = [result for result in results if isinstance(result, tuple)]
+        if done:
+            await run_db(self.repository.delete, done)
+        if retries or deferred:
+            await run_db(self.repository.reschedule, retries + deferred)
+        next_ready = min((ready for _, ready, _ in retries + deferred), default=None)
+        return len(done), next_ready
+
+    async def _send(self, bot: Bot, message_id: int, chat_id: int, text: str, document: str | None,
+                    attempts: int) -> int | tuple[int, float, int]:
+        """Send one message. Returns its id once it is sent or dropped, or its
+        (id, not_before, attempts) when it has to be retried later."""
+        await self.bucket.acquire()
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+
+        try:
+            if document:
+                await bot.send_document(chat_id=chat_id, document=document, caption=text)
+            else:
+                await bot.send_message(chat_id=chat_id, text=text)
+            self.sent += 1
+            return message_id
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            log.warning(f"Flood limit hit, pausing every send for {retry_after}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            # not the message's fault, it keeps its attempts
+            return message_id, time.time() + retry_after, attempts
+        except Forbidden as e:
+            log.info(f"Dropping message to {chat_id}, the bot cannot reach it: {e}")
+        except BadRequest as e:
+            if document:
+                log.warning(f"Document for {chat_id} was rejected, sending the text alone: {e}")
+                return await self._send(bot, message_id, chat_id, text, None, attempts)
+            log.warning(f"Dropping message to {chat_id}: {e}")
+        except NetworkError as e:
+            attempts += 1
+            if attempts < self.max_attempts:
+                backoff = random.uniform(0, self.chat_interval * 2 ** attempts)
+                log.warning(f"Sending to {chat_id} failed ({e}), retry {attempts} in {backoff:.1f}s")
+                return message_id, time.time() + backoff, attempts
+            log.error(f"Dropping message to {chat_id} after {attempts} attempts: {e}")
+        except TelegramError as e:
+            log.error(f"Dropping message to {chat_id}: {e}")
+        self.dropped += 1
+        return message_id
+
+
+# global dispatcher, started with the application
+dispatcher = Dispatcher(
+    outboxRepo,
+    rate=config.DISPATCH_RATE,
+    burst=config.DISPATCH_BURST,
+    chat_interval=config.DISPATCH_CHAT_INTERVAL,
+    batch_size=config.DISPATCH_BATCH_SIZE,
+    idle_poll=config.DISPATCH_IDLE_POLL,
+    max_attempts=config.DISPATCH_MAX_ATTEMPTS,
+)
@@ -1,41 +1,218 @@
+import functools
+import os
 import requests
 import logger
-from io import BytesIO
-import img2pdf
+import tempfile
 import time 
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable
+from requests.adapters import HTTPAdapter
+
+import config
+from cache import page_cache
+from metrics import download_bytes, download_page_seconds, download_pages, pdf_seconds, timed
+from optimizer import OptimizedPage, OptimizeSettings, page_optimizer
+from pdfwriter import PdfWriter
+from ratelimit import adaptive_limiter
 
 log = logger.get_logger(__name__)
 
-def download_pdf(urls: list[str]) -> BytesIO:
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/115.0.0.0 Safari/537.36"
-        )
-    }
-    img_bytes_list = []
-
-    for page_nr, url in enumerate(urls, start=1):
-        log.info(f"Downloading page {page_nr}/{len(urls)}")
-
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
+CHUNK_SIZE = 64 * 1024
+
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/115.0.0.0 Safari/537.36"
+    )
+}
+
+
+def _create_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class PageUnavailable(Exception):
+    """A page still failed after every retry, the site may serve it again later."""
+
+
+# shared keep-alive session, one pooled connection per page worker of every chapter built at once
+session = _create_session(config.DOWNLOAD_WORKERS * config.DOWNLOAD_THREADS)
+
+
+@timed(download_page_seconds)
+def fetch_page(url: str, path: str) -> bool:
+    """Stream one image to `path`, retrying network errors, 429 and 5xx with jittered exponential backoff.
+
+    Pages of the page cache are reused as is while fresh, and revalidated with
+    a conditional request once stale. Every attempt holds a slot of the
+    adaptive limiter of the image host. Returns False when the site refused
+    the page, raises PageUnavailable when it still failed after the retries
+    and CircuitOpenError when the host is known to be down.
+    """
+    entry = page_cache.lookup(url)
+    if entry is not None and page_cache.is_fresh(entry) and page_cache.restore(entry, path):
+        download_pages.inc(outcome="cached")
+        return True
+
+    limiter = adaptive_limiter.for_url(url)
+    for attempt in range(config.DOWNLOAD_RETRIES + 1):
+        headers = page_cache.conditional_headers(entry) if entry is not None else None
+        try:
+            timeout = (config.DOWNLOAD_CONNECT_TIMEOUT, config.DOWNLOAD_READ_TIMEOUT)
+            with limiter.slot() as slot, session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                slot.record_status(response.status_code)
+                if response.status_code == 304 and entry is not None:
+                    if page_cache.restore(entry, path, validated=True):
+                        download_pages.inc(outcome="revalidated")
+                        return True
+                    # evicted meanwhile, download it again
+                    entry = None
+                    continue
+                if response.status_code == 200:
+                    with open(path, "wb") as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                    download_bytes.inc(os.path.getsize(path))
+                    download_pages.inc(outcome="ok")
+                    page_cache.store(url, path, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                    return True
             log.warning(f"Failed to download image from {url}. Status code: {response.status_code}")
-            continue
+            if response.status_code != 429 and response.status_code < 500:
+                download_pages.inc(outcome="failed")
+                return False
+        except requests.RequestException as e:
+            log.warning(f"Failed to download image from {url}: {e}")
 
-        img_bytes_list.append(response.content)
+        if attempt < config.DOWNLOAD_RETRIES:
+            download_pages.inc(outcome="retried")
+            # full jitter, so retrying workers do not hit the server in lockstep
+            time.sleep(random.uniform(0, config.DOWNLOAD_BACKOFF * 2 ** attempt))
+    download_pages.inc(outcome="failed")
+    raise PageUnavailable(f"Could not download {url} after {config.DOWNLOAD_RETRIES + 1} attempts")
 
-        # Random short delay between requests
-        time.sleep(random.uniform(0.01, 0.1))
 
-    if not img_bytes_list:
-        raise ValueError("No valid images downloaded. Cannot create PDF.")
+def _fetch_page_or_none(url: str, path: str) -> bool | None:
+    """fetch_page, returning None instead of raising when the page is only unavailable for now."""
+    try:
+        return fetch_page(url, path)
+    except PageUnavailable:
+        return None
 
-    pdf_buffer = BytesIO()
-    pdf_buffer.write(img2pdf.convert(img_bytes_list))
-    pdf_buffer.seek(0)
-    log.info("PDF created successfully")
 
-    return pdf_buffer
\ No newline at end of file
+def _remove(*paths: str) -> None:
+    for path in set(paths):
+        os.remove(path)
+
+
+def _fetch_and_optimize(url: str, path: str,
+                        settings: OptimizeSettings | None) -> tuple[bool | None, OptimizedPage | None]:
+    """Fetch a page, then optimize it on the process pool when `settings` are given."""
+    ok = _fetch_page_or_none(url, path)
+    if not ok or settings is None:
+        return ok, None
+    try:
+        return ok, page_optimizer.optimize(path, settings)
+    except Exception as e:
+        # the page goes in the PDF as downloaded
+        log.warning(f"Could not optimize page {url}: {e}")
+        return ok, None
+
+
+def download_pdf(urls: list[str], progress: Callable[[int, int], None] | None = None,
+                 cancelled: threading.Event | None = None) -> BinaryIO:
+    """Download the pages of a chapter and build a PDF from them.
+
+    Pages are spooled to a temporary directory as they arrive and appended, in
+    order, to a PDF written incrementally to an anonymous temporary file, so
+    memory does not grow with the chapter size. The returned file is
+    positioned at the start and must be closed by the caller.
+
+    `progress` is called with the pages done and the page count after every
+    page. Setting `cancelled` stops the download at the next page with
+    DownloadCancelled, pages not being downloaded yet are dropped.
+
+    With the page cache enabled, a chapter some pages of which are unavailable
+    for now fails with PageUnavailable once the other pages are downloaded and
+    cached, so building it again only downloads the missing ones. Without it
+    these pages are left out of the PDF.
+
+    With the page optimizer enabled, pages are downscaled, sliced and
+    recompressed on its process pool as they arrive, the PDF only gets the
+    optimized images.
+    """
+    started = time.monotonic()
+    settings = page_optimizer.settings(len(urls)) if page_optimizer.enabled else None
+    optimized: list[OptimizedPage] = []
+    workers = max(1, min(config.DOWNLOAD_WORKERS, len(urls)))
+    pdf_file = tempfile.TemporaryFile(prefix="chapter-", suffix=".pdf")
+    try:
+        # in the page cache directory, pages are moved in and out of the cache as hard links
+        with tempfile.TemporaryDirectory(prefix="chapter-", dir=page_cache.spool_dir) as directory:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="page")
+            try:
+                paths = [os.path.join(directory, f"{page_nr:04d}.img") for page_nr in range(1, len(urls) + 1)]
+                writer = PdfWriter(pdf_file)
+                unavailable = 0
+                added = 0
+                fetch = functools.partial(_fetch_and_optimize, settings=settings)
+                # map yields in chapter order, each page is written as soon as the ones before it are
+                for page_nr, (url, path, (ok, page)) in enumerate(zip(urls, paths, executor.map(fetch, urls, paths)), start=1):
+                    if cancelled is not None and cancelled.is_set():
+                        raise DownloadCancelled(f"Download cancelled after {page_nr - 1}/{len(urls)} pages")
+                    page_paths = [path] if page is None else page.paths
+                    if page is not None:
+                        optimized.append(page)
+                    if ok is None:
+                        unavailable += 1
+                    elif ok and unavailable and page_cache.enabled:
+                        # the PDF is not built anymore, the page is only kept in the page cache
+                        _remove(path, *page_paths)
+                    elif ok:
+                        try:
+                            with pdf_seconds.time(phase="add_image"):
+                                for page_path in page_paths:
+                                    writer.add_image(page_path)
+                            added += 1
+                        except Exception as e:
+                            log.warning(f"Page {page_nr} from {url} is not a valid image: {e}")
+                        finally:
+                            _remove(path, *page_paths)
+                    if progress is not None:
+                        progress(page_nr, len(urls))
+            finally:
+                # running page downloads finish before their directory is removed
+                executor.shutdown(cancel_futures=True)
+
+            log.info(f"Downloaded {added}/{len(urls)} pages in {time.monotonic() - started:.2f}s")
+            if optimized:
+                original_size = sum(page.original_size for page in optimized)
+                size = sum(page.size for page in optimized)
+                log.info(
+                    f"Optimized {len(optimized)} pages from {original_size / 2**20:.1f} MB to {size / 2**20:.1f} MB, "
+                    f"{original_size - size} bytes saved in {sum(page.seconds for page in optimized):.2f}s"
+                )
+            if unavailable and page_cache.enabled:
+                raise PageUnavailable(f"{unavailable}/{len(urls)} pages are unavailable, the others were cached")
+            if not writer.pages:
+                raise ValueError("No valid images downloaded. Cannot create PDF.")
+            with pdf_seconds.time(phase="finalize"):
+                writer.close()
+    except Exception:
+        pdf_file.close()
+        raise
+
+    pdf_file.seek(0)
+    pdf_seconds.observe(time.monotonic() - started, phase="total")
+    log.info("PDF created successfully")
+    return pdf_file
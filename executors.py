@@ -0,0 +1,90 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+import config
+import logger
+from metrics import event_loop_lag_seconds
+
+log = logger.get_logger(__name__)
+
+# blocking work is split in categories, each with its own bounded thread pool,
+# so a burst of downloads can never starve database access or scraping
+SCRAPE = "scrape"
+DOWNLOAD = "download"
+DB = "db"
+
+pools: dict[str, ThreadPoolExecutor] = {
+    SCRAPE: ThreadPoolExecutor(max_workers=config.SCRAPE_THREADS, thread_name_prefix=SCRAPE),
+    DOWNLOAD: ThreadPoolExecutor(max_workers=config.DOWNLOAD_THREADS, thread_name_prefix=DOWNLOAD),
+    DB: ThreadPoolExecutor(max_workers=config.DB_THREADS, thread_name_prefix=DB),
+}
+
+
+async def run_in(category: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a blocking call on the thread pool of `category` and await its result.
+
+    The call sees the caller's context variables, so its log lines keep the correlation id.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pools[category], context.run, partial(fn, *args, **kwargs))
+
+async def run_scrape(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    return await run_in(SCRAPE, fn, *args, **kwargs)
+
+async def run_download(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    return await run_in(DOWNLOAD, fn, *args, **kwargs)
+
+async def run_db(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    return await run_in(DB, fn, *args, **kwargs)
+
+
+def queued() -> dict[str, int]:
+    """Number of calls waiting for a free thread, per category."""
+    return {category: pool._work_queue.qsize() for category, pool in pools.items()}
+
+
+def shutdown() -> None:
+    for pool in pools.values():
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a sleep.
+
+    Any lag means something blocked the loop, which delays every update being
+    processed at the same time.
+    """
+
+    def __init__(self, interval: float, warn_after: float) -> None:
+        self.interval = interval
+        self.warn_after = warn_after
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, time.monotonic() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            event_loop_lag_seconds.set(self.last_lag)
+            if self.last_lag > self.warn_after:
+                log.warning(f"Event loop blocked for {self.last_lag * 1000:.0f}ms, queued blocking calls: {queued()}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+loop_lag_monitor = LoopLagMonitor(config.LOOP_LAG_INTERVAL, config.LOOP_LAG_WARN)
@@ -0,0 +1,237 @@
+"""Local stand-in for WeebCentral, serving synthetic pages with the same structure.
+
+Point the bot at it with WEEBCENTRAL_URL=http://127.0.0.1:8000/ to measure it
+without touching the live site:
+
+    python fakesite.py --mangas 100 --chapters 50 --pages 40 --latency 0.05
+"""
+import argparse
+import datetime
+import hashlib
+import html
+import io
+import random
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image, ImageDraw
+
+import logger
+
+log = logger.get_logger(__name__)
+
+# the first chapter of every manga, later ones follow one RELEASE_GAP apart
+EPOCH = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+RELEASE_GAP = datetime.timedelta(days=7)
+
+
+class FakeSite:
+    """Synthetic catalog: `mangas` mangas with `chapters` chapters of `pages` images each.
+
+    Every response is delayed by `latency` seconds (plus up to `jitter`) and
+    fails with a 503 with probability `error_rate`.
+    """
+
+    def __init__(self, mangas: int = 20, chapters: int = 20, pages: int = 20, image_width: int = 800,
+                 image_height: int = 1200, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0) -> None:
+        self.chapter_counts = [chapters] * mangas
+        self.pages = pages
+        self.image_width = image_width
+        self.image_height = image_height
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def release(self, manga_id: int) -> None:
+        """Publish the next chapter of a manga."""
+        with self._lock:
+            self.chapter_counts[manga_id] += 1
+
+    def release_all(self) -> None:
+        for manga_id in range(len(self.chapter_counts)):
+            self.release(manga_id)
+
+    @staticmethod
+    def title(manga_id: int) -> str:
+        return f"Fake Manga {manga_id}"
+
+    @staticmethod
+    def manga_path(manga_id: int) -> str:
+        return f"/series/{manga_id}/fake-manga-{manga_id}"
+
+    @staticmethod
+    def chapter_path(manga_id: int, number: int) -> str:
+        return f"/chapters/{manga_id}-{number}"
+
+    @staticmethod
+    def published_at(number: int) -> str:
+        return (EPOCH + (number - 1) * RELEASE_GAP).isoformat()
+
+    # ====== PAGES ======
+    def homepage(self) -> str:
+        # the quick search results are filled in by script, like the real site does with htmx
+        return """<html><head><title>Fake WeebCentral</title></head><body>
+<header><section><div><a href="/">Home</a></div><div>
+<input id="quick-search-input" type="text">
+<section><div></div><div id="quick-search-results"></div></section>
+</div></section></header>
+<main></main>
+<script>
+const input = document.getElementById("quick-search-input");
+input.addEventListener("input", async () => {
+  const response = await fetch("/search/data?text=" + encodeURIComponent(input.value));
+  document.getElementById("quick-search-results").innerHTML = await response.text();
+});
+</script>
+</body></html>"""
+
+    def search(self, query: str) -> str:
+        query = query.lower()
+        links = [
+            f'<a href="{self.manga_path(manga_id)}">{html.escape(self.title(manga_id))}</a>'
+            for manga_id in range(len(self.chapter_counts))
+            if query in self.title(manga_id).lower()
+        ]
+        return "".join(links[:10])
+
+    def manga(self, manga_id: int) -> str:
+        rows = [
+            f'<div class="chapter"><a href="{self.chapter_path(manga_id, number)}"><span>Chapter {number}</span>'
+            f'<span>new</span></a><time datetime="{self.published_at(number)}">{self.published_at(number)}</time></div>'
+            for number in range(self.chapter_counts[manga_id], 0, -1)
+        ]
+        return (f"<html><body><main><h1>{html.escape(self.title(manga_id))}</h1>"
+                f'<div id="chapter-list">{"".join(rows)}</div></main></body></html>')
+
+    def chapter(self, manga_id: int, number: int) -> str:
+        return f"""<html><body><main>
+<section><div><div>
+<a href="{self.manga_path(manga_id)}"><div>{html.escape(self.title(manga_id))}</div></a>
+<button>Chapter {number}</button>
+</div></div></section>
+<section></section>
+<section><div hx-get="{self.chapter_path(manga_id, number)}/images" hx-trigger="load"></div></section>
+</main></body></html>"""
+
+    def chapter_images(self, manga_id: int, number: int) -> str:
+        images = "".join(
+            f'<img src="/images/{manga_id}/{number}/{page}.jpg">' for page in range(1, self.pages + 1)
+        )
+        return f"<section>{images}</section>"
+
+    @lru_cache(maxsize=256)
+    def image(self, manga_id: int, number: int, page: int) -> bytes:
+        """A distinct, deterministic JPEG for every page."""
+        rng = random.Random(f"{manga_id}/{number}/{page}")
+        image = Image.new("RGB", (self.image_width, self.image_height), "white")
+        draw = ImageDraw.Draw(image)
+        for _ in range(40):
+            x, y = rng.randrange(self.image_width), rng.randrange(self.image_height)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.rectangle((x, y, x + rng.randrange(50, 300), y + rng.randrange(50, 300)), fill=color)
+        draw.text((20, 20), f"{self.title(manga_id)} - {number} - {page}", fill="black")
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=85)
+        return buffer.getvalue()
+
+    # ====== ROUTING ======
+    def route(self, path: str, query: dict[str, list[str]]) -> tuple[int, str, bytes]:
+        """Return the status, content type and body of a GET request."""
+        parts = [part for part in path.split("/") if part]
+        try:
+            if not parts:
+                return 200, "text/html", self.homepage().encode()
+            if parts[:2] == ["search", "data"]:
+                return 200, "text/html", self.search(query.get("text", [""])[0]).encode()
+            if parts[0] == "series" and len(parts) >= 2:
+                manga_id = int(parts[1])
+                return 200, "text/html", self.manga(manga_id).encode()
+            if parts[0] == "chapters" and len(parts) >= 2:
+                manga_id, number = map(int, parts[1].split("-"))
+                if not 1 <= number <= self.chapter_counts[manga_id]:
+                    raise IndexError(number)
+                if len(parts) == 3 and parts[2] == "images":
+                    return 200, "text/html", self.chapter_images(manga_id, number).encode()
+                return 200, "text/html", self.chapter(manga_id, number).encode()
+            if parts[0] == "images" and len(parts) == 4:
+                manga_id, number, page = int(parts[1]), int(parts[2]), int(parts[3].removesuffix(".jpg"))
+                if not 1 <= page <= self.pages:
+                    raise IndexError(page)
+                return 200, "image/jpeg", self.image(manga_id, number, page)
+        except (ValueError, IndexError):
+            pass
+        return 404, "text/plain", b"Not found"
+
+    def handler(self) -> type[BaseHTTPRequestHandler]:
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                with site._lock:
+                    site.requests += 1
+                delay = site.latency + random.uniform(0, site.jitter)
+                if delay:
+                    time.sleep(delay)
+                if random.random() < site.error_rate:
+                    status, content_type, body = 503, "text/plain", b"Service unavailable"
+                else:
+                    url = urlparse(self.path)
+                    status, content_type, body = site.route(url.path, parse_qs(url.query))
+                # images never change, they are revalidated by their ETag
+                etag = f'"{hashlib.md5(body).hexdigest()}"' if content_type == "image/jpeg" else None
+                if etag is not None and self.headers.get("If-None-Match") == etag:
+                    status, body = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return Handler
+
+
+def serve(site: FakeSite, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Serve `site` on a daemon thread. Port 0 picks a free port, read it from `server_address`."""
+    server = ThreadingHTTPServer((host, port), site.handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fakesite", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--mangas", type=int, default=20)
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 503")
+    args = parser.parse_args()
+
+    site = FakeSite(args.mangas, args.chapters, args.pages, latency=args.latency,
+                    jitter=args.jitter, error_rate=args.error_rate)
+    server = ThreadingHTTPServer((args.host, args.port), site.handler())
+    server.daemon_threads = True
+    log.info(f"Fake WeebCentral listening on http://{args.host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import heapq
+import itertools
+import threading
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable
+
+import logger
+
+log = logger.get_logger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    PREFETCH = 1
+
+
+class QueueFullError(Exception):
+    """The download queue admits no more jobs of this priority right now."""
+
+
+class JobCancelled(Exception):
+    """The download was cancelled before it finished."""
+
+
+@dataclass(eq=False)
+class DownloadJob:
+    """The build of one chapter PDF, shared by every request for that chapter."""
+
+    chapter_url: str
+    filename: str
+    priority: Priority
+    seq: int
+    future: asyncio.Future
+    # set to stop the page downloads of a running build, checked from the download thread
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    tickets: list["Ticket"] = field(default_factory=list)
+    task: asyncio.Task | None = None
+    pages_done: int = 0
+    pages_total: int = 0
+
+    @property
+    def started(self) -> bool:
+        return self.task is not None
+
+    def report(self, done: int, total: int) -> None:
+        """Progress callback of the build, may be called from any thread."""
+        self.pages_done, self.pages_total = done, total
+
+
+@dataclass(eq=False)
+class Ticket:
+    """One requester waiting for a job."""
+
+    job: DownloadJob
+    owner: int | None
+    future: asyncio.Future
+
+
+class DownloadQueue:
+    """Builds chapter PDFs on `workers` workers, interactive requests before prefetches.
+
+    At most `max_queued` jobs wait for a worker, prefetches only while the
+    queue is less than half full so they never crowd out users. Requests for a
+    chapter already queued or building join that job, and an interactive
+    request moves a queued prefetch of its chapter up to its own priority.
+    A job is cancelled once every requester waiting for it has left.
+    """
+
+    def __init__(self, build: Callable[[DownloadJob], Awaitable[Any]], workers: int, max_queued: int) -> None:
+        self.build = build
+        self.workers = workers
+        self.max_queued = max_queued
+
+        self._heap: list[tuple[int, int, DownloadJob]] = []
+        self._jobs: dict[str, DownloadJob] = {}  # queued or building, by chapter url
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+
+    def __contains__(self, chapter_url: str) -> bool:
+        return chapter_url in self._jobs
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for job in self._jobs.values() if not job.started)
+
+    @property
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.started)
+
+    def submit(self, chapter_url: str, filename: str, priority: Priority, owner: int | None = None) -> Ticket:
+        """Queue the build of a chapter, or join the one in progress. Raises QueueFullError."""
+        job = self._jobs.get(chapter_url)
+        if job is None:
+            limit = self.max_queued if priority == Priority.INTERACTIVE else self.max_queued // 2
+            if self.queued >= limit:
+                raise QueueFullError(f"{self.queued} downloads are already queued")
+            loop = asyncio.get_running_loop()
+            job = DownloadJob(chapter_url, filename, priority, next(self._seq), loop.create_future())
+            job.future.add_done_callback(lambda _: self._finish(job))
+            self._jobs[chapter_url] = job
+            self._push(job)
+        elif priority < job.priority:
+            job.priority = priority
+            if not job.started:
+                # the old heap entry is skipped once this one was taken
+                self._push(job)
+
+        ticket = Ticket(job, owner, asyncio.get_running_loop().create_future())
+        job.tickets.append(ticket)
+        self._start_workers()
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based place of a queued job among the queued jobs, 0 once it is building."""
+        job = ticket.job
+        if job.started or job.future.done():
+            return 0
+        return 1 + sum(
+            1 for other in self._jobs.values()
+            if not other.started and (other.priority, other.seq) < (job.priority, job.seq)
+        )
+
+    async def wait(self, ticket: Ticket) -> Any:
+        """The result of the job. Raises JobCancelled when the ticket or the job was cancelled."""
+        try:
+            return await asyncio.shield(ticket.future)
+        except asyncio.CancelledError:
+            self.cancel_ticket(ticket)
+            raise
+
+    def cancel_ticket(self, ticket: Ticket) -> bool:
+        if ticket.future.done():
+            return False
+        ticket.future.set_exception(JobCancelled())
+        # nobody retrieves it when the requester itself was cancelled
+        ticket.future.exception()
+        job = ticket.job
+        job.tickets.remove(ticket)
+        if not job.tickets:
+            self._cancel_job(job)
+        return True
+
+    def cancel(self, owner: int) -> int:
+        """Cancel every download `owner` is waiting for, returning how many."""
+        tickets = [ticket for job in self._jobs.values() for ticket in job.tickets if ticket.owner == owner]
+        return sum(self.cancel_ticket(ticket) for ticket in tickets)
+
+    def _cancel_job(self, job: DownloadJob) -> None:
+        log.info(f"Cancelling the download of {job.chapter_url}")
+        job.cancelled.set()
+        if job.task is not None:
+            job.task.cancel()
+        elif not job.future.done():
+            job.future.set_exception(JobCancelled())
+
+    def _push(self, job: DownloadJob) -> None:
+        heapq.heappush(self._heap, (job.priority, job.seq, job))
+        self._wakeup.set()
+
+    def _finish(self, job: DownloadJob) -> None:
+        if self._jobs.get(job.chapter_url) is job:
+            del self._jobs[job.chapter_url]
+        error = JobCancelled() if job.future.cancelled() else job.future.exception()
+        for ticket in job.tickets:
+            if ticket.future.done():
+                continue
+            if error is not None:
+                ticket.future.set_exception(error)
+            else:
+                ticket.future.set_result(job.future.result())
+
+    def _start_workers(self) -> None:
+        if self._workers:
+            return
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(self._work()) for _ in range(self.workers)]
+
+    async def _next_job(self) -> DownloadJob:
+        while True:
+            while self._heap:
+                priority, _, job = heapq.heappop(self._heap)
+                # skip jobs that are done, cancelled or were moved up to another entry
+                if not job.started and not job.future.done() and priority == job.priority:
+                    return job
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._next_job()
+            job.task = asyncio.get_running_loop().create_task(self.build(job))
+            try:
+                result = await job.task
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    # the worker itself is being stopped
+                    job.cancelled.set()
+                    job.task.cancel()
+                    raise
+                if not job.future.done():
+                    job.future.set_exception(JobCancelled())
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
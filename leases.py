@@ -0,0 +1,116 @@
+import math
+import time
+import zlib
+from abc import ABC, abstractmethod
+
+import config
+import logger
+from db import LeaseRepository
+from executors import run_db
+from repo import leaseRepo
+
+log = logger.get_logger(__name__)
+
+
+def shard_of(manga_url: str, shards: int) -> int:
+    """Shard of a manga, stable across processes and restarts unlike hash()."""
+    return zlib.crc32(manga_url.encode()) % shards
+
+
+class LeaseBackend(ABC):
+    """Shared store of the worker heartbeats and shard leases. Its methods block."""
+
+    @abstractmethod
+    def heartbeat(self, owner: str, ttl: float) -> list[int]:
+        """Mark `owner` alive and renew its leases, returning the shards it still holds."""
+
+    @abstractmethod
+    def count_workers(self) -> int: ...
+
+    @abstractmethod
+    def acquire(self, owner: str, count: int, ttl: float) -> list[int]:
+        """Take up to `count` free or expired shards, returning the ones taken."""
+
+    @abstractmethod
+    def release(self, owner: str, shards: list[int]) -> None: ...
+
+    @abstractmethod
+    def leave(self, owner: str) -> None: ...
+
+
+class SqliteLeaseBackend(LeaseBackend):
+    """Leases in the shared sqlite database, for workers running on the same host as it."""
+
+    def __init__(self, repository: LeaseRepository) -> None:
+        self.repository = repository
+
+    def heartbeat(self, owner: str, ttl: float) -> list[int]:
+        return self.repository.heartbeat(owner, time.time(), ttl)
+
+    def count_workers(self) -> int:
+        return self.repository.count_workers(time.time())
+
+    def acquire(self, owner: str, count: int, ttl: float) -> list[int]:
+        return self.repository.acquire(owner, count, time.time(), ttl)
+
+    def release(self, owner: str, shards: list[int]) -> None:
+        self.repository.release(owner, shards)
+
+    def leave(self, owner: str) -> None:
+        self.repository.leave(owner)
+
+
+def create_lease_backend(name: str) -> LeaseBackend:
+    if name == "sqlite":
+        return SqliteLeaseBackend(leaseRepo)
+    raise ValueError(f"Unknown lease backend: {name}")
+
+
+class ShardLeases:
+    """The shards one worker holds, rebalanced on every heartbeat.
+
+    Each worker aims for an even share of the shards among the live workers:
+    it takes free or expired shards while it has fewer, and gives back the
+    extra ones when a new worker joined, so the checks spread out within a few
+    heartbeats. A worker that dies stops renewing, and its shards are taken
+    over once their lease expired.
+    """
+
+    def __init__(self, backend: LeaseBackend, owner: str, shards: int, ttl: float) -> None:
+        self.backend = backend
+        self.owner = owner
+        self.shards = shards
+        self.ttl = ttl
+        self.held: frozenset[int] = frozenset()
+        self._valid_until = 0.0  # monotonic
+
+    def owns(self, manga_url: str) -> bool:
+        # once the heartbeats stopped, the leases may be held by another worker already
+        return time.monotonic() < self._valid_until and shard_of(manga_url, self.shards) in self.held
+
+    async def rebalance(self) -> frozenset[int]:
+        started = time.monotonic()
+        held = await run_db(self.backend.heartbeat, self.owner, self.ttl)
+        workers = max(1, await run_db(self.backend.count_workers))
+        share = math.ceil(self.shards / workers)
+        if len(held) < share:
+            held += await run_db(self.backend.acquire, self.owner, share - len(held), self.ttl)
+        elif len(held) > share:
+            extra = held[share:]
+            await run_db(self.backend.release, self.owner, extra)
+            held = held[:share]
+
+        held = frozenset(held)
+        if held != self.held:
+            log.info(f"Worker {self.owner} holds {len(held)}/{self.shards} shards ({workers} workers)")
+        self.held = held
+        self._valid_until = started + self.ttl
+        return held
+
+    async def leave(self) -> None:
+        self.held = frozenset()
+        await run_db(self.backend.leave, self.owner)
+
+
+def create_shard_leases(owner: str) -> ShardLeases:
+    return ShardLeases(create_lease_backend(config.LEASE_BACKEND), owner, config.NOTIFIER_SHARDS, config.LEASE_TTL)
@@ -1,8 +1,43 @@
+import contextvars
+import json
 import logging
 
-formatter = logging.Formatter(
-    '%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(funcName)s() - %(message)s'
-)
+import config
+
+# id of the telegram update or job run being handled, attached to every log line it causes
+correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar("correlation_id", default="-")
+
+
+class CorrelationFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.lineno}",
+            "function": record.funcName,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+if config.LOG_FORMAT == "json":
+    formatter = JsonFormatter()
+else:
+    formatter = logging.Formatter(
+        '%(asctime)s - %(levelname)s - [%(correlation_id)s] - %(filename)s:%(lineno)d - %(funcName)s() - %(message)s'
+    )
 
 def get_logger(name: str) -> logging.Logger:
     logger = logging.getLogger(name) 
@@ -11,6 +46,7 @@ def get_logger(name: str) -> logging.Logger:
     if not logger.handlers:  
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
+        handler.addFilter(CorrelationFilter())
         logger.addHandler(handler)
 
     return logger
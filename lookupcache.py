@@ -0,0 +1,108 @@
+import datetime
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+import config
+import logger
+from db import LookupCacheRepository
+from executors import run_db
+from metrics import lookup_cache_requests
+from repo import lookupCacheRepo
+from scraper import Chapter, Manga
+
+log = logger.get_logger(__name__)
+
+
+class LookupCache:
+    """In-process LRU of at most `max_size` entries, each valid for `ttl` seconds.
+
+    With a repository, entries are also written to the database and a memory
+    miss falls back to it, so the cache survives restarts. `encode` and
+    `decode` turn values into the text stored there.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: float, repository: LookupCacheRepository | None = None,
+                 encode: Callable[[Any], str] = json.dumps, decode: Callable[[str], Any] = json.loads) -> None:
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.repository = repository
+        self.encode = encode
+        self.decode = decode
+
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def get(self, key: str) -> Any | None:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                return self._hit(value)
+            del self._entries[key]
+
+        if self.repository is not None:
+            stored = await run_db(self.repository.find_value, self.name, key, now)
+            if stored is not None:
+                value = self.decode(stored)
+                # the stored expiry is not known here, a fresh ttl is close enough for a restart
+                self._remember(key, value, now + self.ttl)
+                return self._hit(value)
+
+        self.misses += 1
+        lookup_cache_requests.inc(cache=self.name, result="miss")
+        return None
+
+    async def put(self, key: str, value: Any) -> None:
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.repository is not None:
+            await run_db(self.repository.save_value, self.name, key, self.encode(value), expires_at)
+
+    def _hit(self, value: Any) -> Any:
+        self.hits += 1
+        lookup_cache_requests.inc(cache=self.name, result="hit")
+        return value
+
+    def _remember(self, key: str, value: Any, expires_at: float) -> None:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+# ====== ENCODING ======
+def encode_mangas(mangas: list[Manga]) -> str:
+    return json.dumps([[manga.title, manga.url] for manga in mangas])
+
+def decode_mangas(value: str) -> list[Manga]:
+    return [Manga(title=title, url=url) for title, url in json.loads(value)]
+
+def encode_chapter(chapter: Chapter) -> str:
+    published_at = chapter.published_at
+    if isinstance(published_at, datetime.datetime):
+        published_at = published_at.isoformat()
+    return json.dumps([chapter.title, chapter.url, published_at])
+
+def decode_chapter(value: str) -> Chapter:
+    title, url, published_at = json.loads(value)
+    return Chapter(title=title, url=url, published_at=datetime.datetime.fromisoformat(published_at))
+
+
+repository = lookupCacheRepo if config.LOOKUP_CACHE_PERSIST else None
+# search results keyed by normalized query
+search_cache = LookupCache("search", config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL,
+                           repository, encode_mangas, decode_mangas)
+# newest chapter keyed by manga url, also filled by every notifier check
+last_chapter_cache = LookupCache("last_chapter", config.LAST_CHAPTER_CACHE_SIZE, config.LAST_CHAPTER_CACHE_TTL,
+                                 repository, encode_chapter, decode_chapter)
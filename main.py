@@ -1,3 +1,4 @@
+import asyncio
 from datetime import time, timedelta
 import dotenv
 import logging as log
@@ -5,13 +6,43 @@ import pytz
 from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters
 from telegram.request import HTTPXRequest
 import tg
-import os
-import sys
+import config
+from config import resource_path
+from pool import browser_pool
+from repo import database
+from backends import backend
+import executors
+from executors import loop_lag_monitor, run_scrape
+from dispatcher import dispatcher
+from catalog import catalog
+from prefetch import prefetcher
+from chapters import download_queue
+from optimizer import page_optimizer
+from metrics import MetricsServer
+from webhook import run_webhook
 
-def resource_path(relative_path):
-    """Get absolute path to resource, works for dev and for PyInstaller"""
-    base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(sys.argv[0])))
-    return os.path.join(base_path, relative_path)
+metrics_server = MetricsServer(config.METRICS_HOST, config.METRICS_PORT)
+
+
+async def startup(application) -> None:
+    loop_lag_monitor.start()
+    if config.METRICS_PORT:
+        metrics_server.start()
+    dispatcher.start(application.bot)
+    await run_scrape(browser_pool.warm_up)
+
+async def shutdown(application) -> None:
+    loop_lag_monitor.stop()
+    metrics_server.stop()
+    await dispatcher.stop()
+    await catalog.close()
+    await prefetcher.close()
+    await download_queue.close()
+    page_optimizer.close()
+    await backend.close()
+    browser_pool.close()
+    executors.shutdown()
+    database.close()
 
 def main():
     api_key = dotenv.get_key(resource_path(".env"), "TELEGRAM_API_KEY")
@@ -20,7 +51,14 @@ def main():
         return
     
     request = HTTPXRequest(connect_timeout=30, read_timeout=60)
-    bot = ApplicationBuilder().token(api_key).request(request).build()
+    bot = (
+        ApplicationBuilder()
+        .token(api_key)
+        .request(request)
+        .post_init(startup)
+        .post_shutdown(shutdown)
+        .build()
+    )
 
     # conversation handler add manga
     add_manga_conv = ConversationHandler(
@@ -43,6 +81,8 @@ def main():
     start_handler = CommandHandler('start', tg.start)
     help_handler = CommandHandler('help', tg.help)
     download_handler = CommandHandler("download", tg.download)
+    # outside of a conversation /cancel stops the user's downloads
+    cancel_handler = CommandHandler("cancel", tg.cancel)
 
     bot.add_handler(start_handler)
     bot.add_handler(help_handler)
@@ -50,15 +90,22 @@ def main():
     bot.add_handler(add_manga_conv)
     bot.add_handler(manage_manga_conv)
     bot.add_handler(download_handler)
+    bot.add_handler(cancel_handler)
 
     log.info("Starting the bot...")
 
     # add notifier
     # brussels_time = time(hour=13, minute=30, tzinfo=pytz.timezone('Europe/Brussels'))
     # bot.job_queue.run_daily(tg.notifier, time=brussels_time)
-    bot.job_queue.run_repeating(tg.notifier, interval=3600, first=timedelta(minutes=10))
+    # the notifier only checks the mangas the poll scheduler says are due
+    bot.job_queue.run_repeating(tg.notifier, interval=config.NOTIFIER_TICK, first=timedelta(minutes=10))
+    if config.CATALOG_CRAWL_INTERVAL:
+        bot.job_queue.run_repeating(tg.crawl_catalog, interval=config.CATALOG_CRAWL_INTERVAL, first=timedelta(minutes=1))
 
-    bot.run_polling()
+    if config.WEBHOOK_URL:
+        asyncio.run(run_webhook(bot))
+    else:
+        bot.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,230 @@
+import functools
+import inspect
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterator
+
+import logger
+
+log = logger.get_logger(__name__)
+
+# seconds, from a cached sqlite read to a slow chapter build
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def _label_key(labels: dict[str, object]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(key: LabelKey, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metric(ABC):
+    """A named metric with one series per label set, safe to update from any thread."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]: ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values: dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values: dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help)
+        self.buckets = buckets
+        # per label set: count per bucket (non cumulative), sum, count
+        self.series: dict[LabelKey, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = ([0] * len(self.buckets), [0.0, 0])
+            counts, totals = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = [(key, list(counts), list(totals)) for key, (counts, totals) in self.series.items()]
+        for key, counts, (total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(key, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_format_labels(key, le)} {count}"
+            yield f"{self.name}_sum{_format_labels(key)} {total}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+def timed(histogram: Histogram, errors: Counter | None = None, **labels) -> Callable:
+    """Decorator observing the duration of every call of a function or coroutine
+    function in `histogram`, and counting the calls that raised in `errors`."""
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started, **labels)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+# ====== HOT PATH METRICS ======
+scraper_seconds = Histogram("scraper_seconds", "Duration of scraping operations")
+scraper_errors = Counter("scraper_errors_total", "Scraping operations that raised")
+browser_start_seconds = Histogram("browser_start_seconds", "Time to launch a pooled browser")
+page_load_seconds = Histogram("page_load_seconds", "Time to load a page, per backend")
+download_page_seconds = Histogram("download_page_seconds", "Time to download one chapter page, retries included")
+download_bytes = Counter("download_bytes_total", "Bytes of chapter pages downloaded")
+download_pages = Counter("download_pages_total", "Chapter pages by outcome")
+pdf_seconds = Histogram("pdf_seconds", "Phases of building a chapter PDF")
+optimize_seconds = Histogram("image_optimize_seconds", "Time to optimize one chapter page, on the process pool")
+optimize_bytes_saved = Counter("image_optimize_bytes_saved_total", "Bytes of chapter pages saved by the optimization")
+db_seconds = Histogram("db_seconds", "Duration of repository methods")
+db_errors = Counter("db_errors_total", "Repository methods that raised")
+handler_seconds = Histogram("telegram_handler_seconds", "Duration of telegram handlers and jobs")
+handler_errors = Counter("telegram_handler_errors_total", "Telegram handlers and jobs that raised")
+lookup_cache_requests = Counter("lookup_cache_requests_total", "Search and last chapter cache lookups by result")
+adaptive_limit = Gauge("adaptive_concurrency_limit", "Current AIMD concurrency limit, per host")
+adaptive_in_flight = Gauge("adaptive_in_flight", "Requests holding an adaptive limiter slot, per host")
+circuit_state = Gauge("circuit_state", "Circuit breaker per host: 0 closed, 1 half open, 2 open")
+circuit_opened = Counter("circuit_opened_total", "Times the circuit breaker of a host opened")
+event_loop_lag_seconds = Gauge("event_loop_lag_seconds", "Last measured event loop lag")
+
+
+class MetricsServer:
+    """Serves `render()` at /metrics on a daemon thread."""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self._server: ThreadingHTTPServer | None = None
+
+    def start(self) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        log.info(f"Serving metrics on http://{self.host}:{self._server.server_address[1]}/metrics")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
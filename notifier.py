@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import config
+import logger
+from backends import backend
+from dispatcher import OutboxMessage, dispatcher
+from executors import run_db
+from prefetch import prefetcher
+from repo import chapterRepo, digestRepo, mangaRepo, userRepo
+from scheduler import poll_scheduler
+from scraper import Chapter, Manga
+
+log = logger.get_logger(__name__)
+
+# telegram rejects longer text messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dataclass
+class RunSummary:
+    checked: int = 0
+    changed: int = 0
+    failed: int = 0
+    wall_time: float = 0
+    latencies: list[float] = field(default_factory=list)  # seconds spent checking each manga
+
+    def __str__(self) -> str:
+        return f"checked={self.checked} changed={self.changed} failed={self.failed} wall_time={self.wall_time:.1f}s"
+
+
+async def check_mangas(mangas: list[Manga], check: Callable[[Manga], Awaitable[bool]], workers: int) -> RunSummary:
+    """Run `check` on every manga with at most `workers` checks in flight.
+
+    `check` returns True when it found a new chapter. An exception only fails
+    the manga it was raised for, the rest of the run carries on.
+    """
+    summary = RunSummary()
+    started = time.monotonic()
+    queue: asyncio.Queue[Manga] = asyncio.Queue()
+    for manga in mangas:
+        queue.put_nowait(manga)
+
+    async def worker() -> None:
+        while True:
+            try:
+                manga = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            checked_at = time.monotonic()
+            try:
+                if await check(manga):
+                    summary.changed += 1
+            except Exception as e:
+                summary.failed += 1
+                log.error(f"Error checking {manga.title} ({manga.url}): {e}")
+            finally:
+                summary.checked += 1
+                summary.latencies.append(time.monotonic() - checked_at)
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, len(mangas)))))
+    summary.wall_time = time.monotonic() - started
+    return summary
+
+
+async def run_checks(owns: Callable[[str], bool] | None = None) -> RunSummary | None:
+    """Check the subscribed mangas that are due, queueing notifications for their new chapters.
+
+    `owns` limits the run to the mangas whose url it accepts, e.g. those in
+    the shards a worker holds, and is asked again before anything is saved.
+    Returns the summary of the run, None when no manga was due.
+    """
+    # get all mangas from the database
+    mangas = {manga.url: manga for manga in await run_db(mangaRepo.find_all_mangas)
+              if owns is None or owns(manga.url)}
+    if poll_scheduler.sync(mangas):
+        poll_scheduler.learn(await run_db(mangaRepo.find_release_history))
+
+    due = [mangas[url] for url in poll_scheduler.due()]
+    if not due:
+        return
+    log.info(f"Running notifier job for {len(due)}/{len(mangas)} mangas...")
+
+    async def check(manga: Manga) -> bool:
+        new_chapters = []
+        try:
+            scraped_chapters = await backend.get_chapters(manga)
+            if owns is not None and not owns(manga.url):
+                log.info(f"Lost the lease of {manga.url} while checking it")
+                return False
+            known_urls = await run_db(mangaRepo.find_chapter_urls, manga.url)
+            missing_chapters, new_chapters = find_new_chapters(scraped_chapters, known_urls, manga.last_chapter)
+            if not missing_chapters:
+                return False
+
+            # one transaction for the whole diff, the next run starts from here
+            last_chapter = new_chapters[-1] if new_chapters else None
+            await run_db(mangaRepo.save_chapters, manga.url, missing_chapters, last_chapter)
+            poll_scheduler.learn({manga.url: [chapter.published_at for chapter in missing_chapters]})
+            if not new_chapters:
+                return False
+
+            log.info(f"{len(new_chapters)} new chapters found for {manga.title}: {', '.join(c.title for c in new_chapters)}")
+            manga.add_chapter(last_chapter)
+            if prefetcher.enabled and prefetcher.wants(await run_db(userRepo.count_users_by_manga_url, manga.url)):
+                prefetcher.schedule(manga, new_chapters)
+
+            if config.NOTIFY_MODE == "digest":
+                await run_db(digestRepo.add_chapters, manga.url, [chapter.url for chapter in new_chapters], time.time())
+                return True
+
+            # queue a notification for every subscriber, the dispatcher paces the sends
+            user_ids = await run_db(userRepo.find_user_ids_by_manga_url, manga.url)
+            messages = []
+            for chapter in new_chapters:
+                # when the chapter was already uploaded, send the PDF itself at no upload cost
+                file_id = await run_db(chapterRepo.find_file_id, chapter.url)
+                messages.extend(OutboxMessage(user_id, f"{chapter.url}\n", file_id) for user_id in user_ids)
+            await dispatcher.enqueue(messages)
+            return True
+        finally:
+            poll_scheduler.record_check(manga.url, new_chapters[-1].published_at if new_chapters else None)
+
+    summary = await check_mangas(due, check, workers=config.NOTIFIER_WORKERS)
+    log.info(f"Notifier run finished: {summary}")
+    return summary
+
+
+def find_new_chapters(scraped: list[Chapter], known_urls: set[str], last_chapter: Chapter) -> tuple[list[Chapter], list[Chapter]]:
+    """Diff the scraped chapter list of a manga against its stored history.
+
+    Returns the chapters missing from the history and, among them, the ones
+    published after `last_chapter`, oldest first. Older missing chapters
+    only complete the history and are not worth a notification.
+    """
+    missing = [chapter for chapter in scraped if chapter.url not in known_urls]
+    last_published = last_chapter.published_at
+    if isinstance(last_published, str):
+        last_published = datetime.datetime.fromisoformat(last_published)
+    new = sorted((chapter for chapter in missing if chapter.published_at > last_published), key=lambda c: c.published_at)
+    return missing, new
+
+
+def format_digest(items: list[tuple[str, str, str]]) -> list[str]:
+    """Render (manga title, chapter title, chapter url) items, grouped by manga,
+    as the fewest messages that fit telegram's length limit."""
+    lines = [f"{len(items)} new chapters:" if len(items) > 1 else "1 new chapter:"]
+    manga_title = None
+    for title, chapter_title, chapter_url in items:
+        if title != manga_title:
+            manga_title = title
+            lines.extend(["", title])
+        lines.append(f"{chapter_title} - {chapter_url}")
+
+    messages, current = [], ""
+    for line in lines:
+        line = line[:MAX_MESSAGE_LENGTH]
+        if current and len(current) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            messages.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    messages.append(current)
+    return messages
+
@@ -0,0 +1,177 @@
+import io
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from PIL import Image
+
+import config
+import logger
+from metrics import optimize_bytes_saved, optimize_seconds
+
+log = logger.get_logger(__name__)
+
+# quality lowered by this much at a time, then the width by WIDTH_STEP, to fit a page in its budget
+QUALITY_STEP = 10
+WIDTH_STEP = 0.8
+MIN_WIDTH = 400
+# room left in the target size for the PDF structure around the images
+PDF_OVERHEAD = 0.02
+
+
+@dataclass(frozen=True)
+class OptimizeSettings:
+    max_width: int
+    quality: int
+    min_quality: int
+    slice_height: int
+    page_budget: int  # bytes one source page may take, 0 for no limit
+
+
+@dataclass
+class OptimizedPage:
+    paths: list[str]  # in reading order, the source path itself when it was kept
+    original_size: int
+    size: int
+    seconds: float
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    """The image in RGB or grayscale, transparency flattened onto white, ready to be saved as a JPEG."""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        flat = Image.new("RGB", image.size, "white")
+        flat.paste(rgba, mask=rgba.getchannel("A"))
+        return flat
+    if image.mode not in ("RGB", "L"):
+        return image.convert("RGB")
+    return image
+
+
+def _encode(image: Image.Image, quality: int, slice_height: int) -> list[bytes]:
+    """Baseline JPEGs of the image, sliced in even parts no taller than `slice_height`."""
+    width, height = image.size
+    parts = math.ceil(height / slice_height) if slice_height else 1
+    part_height = math.ceil(height / parts)
+    encoded = []
+    for top in range(0, height, part_height):
+        part = image.crop((0, top, width, min(height, top + part_height))) if parts > 1 else image
+        buffer = io.BytesIO()
+        part.save(buffer, "JPEG", quality=quality, optimize=True)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def optimize_page(path: str, settings: OptimizeSettings) -> OptimizedPage:
+    """Downscale, slice and recompress one page. Runs in a worker process of the pool.
+
+    A page that is already a JPEG the PDF embeds as is, small enough and in
+    its budget is kept untouched, and so is one the recompression would not
+    make smaller. Parts of a sliced page are written next to it.
+    """
+    started = time.perf_counter()
+    original_size = os.path.getsize(path)
+    with Image.open(path) as source:
+        embeddable = source.format == "JPEG" and source.mode in ("RGB", "L")
+        width, height = source.size
+        if settings.max_width and width > settings.max_width:
+            width, height = settings.max_width, max(1, round(height * settings.max_width / width))
+        reshaped = (width, height) != source.size or bool(settings.slice_height and height > settings.slice_height)
+        if embeddable and not reshaped and (not settings.page_budget or original_size <= settings.page_budget):
+            return OptimizedPage([path], original_size, original_size, time.perf_counter() - started)
+
+        image = _flatten(source)
+        image.load()
+        if image is source:
+            # the source is closed with the block
+            image = source.copy()
+        if (width, height) != image.size:
+            image = image.resize((width, height), Image.LANCZOS)
+
+    quality = settings.quality
+    while True:
+        parts = _encode(image, quality, settings.slice_height)
+        size = sum(len(part) for part in parts)
+        if not settings.page_budget or size <= settings.page_budget:
+            break
+        if quality > settings.min_quality:
+            quality = max(settings.min_quality, quality - QUALITY_STEP)
+        elif image.width > MIN_WIDTH:
+            width = max(MIN_WIDTH, round(image.width * WIDTH_STEP))
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        else:
+            # the budget cannot be met, the page is as small as it gets
+            break
+
+    if embeddable and not reshaped and size >= original_size:
+        return OptimizedPage([path], original_size, original_size, time.perf_counter() - started)
+    paths = []
+    for part_nr, part in enumerate(parts, start=1):
+        part_path = f"{path}.{part_nr}.jpg"
+        with open(part_path, "wb") as f:
+            f.write(part)
+        paths.append(part_path)
+    return OptimizedPage(paths, original_size, size, time.perf_counter() - started)
+
+
+class PageOptimizer:
+    """Runs optimize_page on a pool of `processes` processes, shared by every chapter being built.
+
+    Decoding and encoding large images is CPU bound, in processes it neither
+    holds the GIL against the event loop nor is limited to one core. The pool
+    is only started by the first page optimized.
+    """
+
+    def __init__(self, enabled: bool, processes: int, max_width: int, quality: int, min_quality: int,
+                 slice_height: int, target_bytes: int) -> None:
+        self.enabled = enabled
+        self.processes = processes
+        self.max_width = max_width
+        self.quality = quality
+        self.min_quality = min(min_quality, quality)
+        self.slice_height = slice_height
+        self.target_bytes = target_bytes
+        self._lock = threading.Lock()
+        self._pool: ProcessPoolExecutor | None = None
+
+    def settings(self, pages: int) -> OptimizeSettings:
+        """Settings for a chapter of `pages` pages, the target size split evenly among them."""
+        budget = int(self.target_bytes * (1 - PDF_OVERHEAD) / pages) if self.target_bytes and pages else 0
+        return OptimizeSettings(self.max_width, self.quality, self.min_quality, self.slice_height, budget)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # forking the threads and sqlite connections of the bot is unsafe, start fresh interpreters
+                self._pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def optimize(self, path: str, settings: OptimizeSettings) -> OptimizedPage:
+        """Optimize one page on the pool and wait for it. Blocks, call it from a download thread."""
+        page = self._get_pool().submit(optimize_page, path, settings).result()
+        optimize_seconds.observe(page.seconds)
+        optimize_bytes_saved.inc(page.original_size - page.size)
+        return page
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+# global page optimizer, used by download_pdf
+page_optimizer = PageOptimizer(
+    enabled=bool(config.OPTIMIZE_ENABLED),
+    processes=config.OPTIMIZE_PROCESSES,
+    max_width=config.OPTIMIZE_MAX_WIDTH,
+    quality=config.OPTIMIZE_QUALITY,
+    min_quality=config.OPTIMIZE_MIN_QUALITY,
+    slice_height=config.OPTIMIZE_SLICE_HEIGHT,
+    target_bytes=int(config.OPTIMIZE_TARGET_MB * 1024 * 1024),
+)
@@ -0,0 +1,114 @@
+import shutil
+import zlib
+from typing import BinaryIO
+
+from PIL import Image
+
+# object numbers reserved for the objects only written on close()
+CATALOG_ID = 1
+PAGES_ID = 2
+DEFAULT_DPI = 96
+
+
+class PdfWriter:
+    """Writes a PDF with one image per page straight to a file, one page at a time.
+
+    Baseline RGB/grayscale JPEGs are embedded as they are, any other image is
+    decoded and stored losslessly with Flate. Only the page being written is
+    ever held in memory, the rest of the document is already on disk.
+    """
+
+    def __init__(self, output: BinaryIO) -> None:
+        self.output = output
+        self.offsets: dict[int, int] = {}
+        self.pages: list[int] = []
+        self._next_id = PAGES_ID + 1
+        self.output.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+    def _new_id(self) -> int:
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _begin(self, obj_id: int) -> None:
+        self.offsets[obj_id] = self.output.tell()
+        self.output.write(f"{obj_id} 0 obj\n".encode())
+
+    def _write_object(self, obj_id: int, body: str) -> None:
+        self._begin(obj_id)
+        self.output.write(f"{body}\nendobj\n".encode())
+
+    def _write_stream(self, obj_id: int, header: str, data: bytes | None = None,
+                      source: BinaryIO | None = None, length: int = 0) -> None:
+        self._begin(obj_id)
+        self.output.write(f"<< {header} /Length {len(data) if data is not None else length} >>\nstream\n".encode())
+        if data is not None:
+            self.output.write(data)
+        else:
+            shutil.copyfileobj(source, self.output)
+        self.output.write(b"\nendstream\nendobj\n")
+
+    def add_image(self, path: str) -> None:
+        """Append a page showing the image at `path`, sized after its resolution."""
+        # decoded before any object number is taken, an invalid image leaves the document untouched
+        with Image.open(path) as image:
+            image.load()
+            width, height = image.size
+            dpi = image.info.get("dpi", (DEFAULT_DPI, DEFAULT_DPI))[0] or DEFAULT_DPI
+            if image.format == "JPEG" and image.mode in ("RGB", "L"):
+                color_space = "/DeviceRGB" if image.mode == "RGB" else "/DeviceGray"
+                header = (f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                          f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter /DCTDecode")
+                data = None
+            else:
+                if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                    # flatten transparency onto white, like a reader would show it
+                    rgba = image.convert("RGBA")
+                    image = Image.new("RGB", image.size, "white")
+                    image.paste(rgba, mask=rgba.getchannel("A"))
+                elif image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                color_space = "/DeviceRGB" if image.mode == "RGB" else "/DeviceGray"
+                header = (f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                          f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter /FlateDecode")
+                data = zlib.compress(image.tobytes(), 6)
+
+        image_id = self._new_id()
+        if data is None:
+            with open(path, "rb") as f:
+                f.seek(0, 2)
+                length = f.tell()
+                f.seek(0)
+                self._write_stream(image_id, header, source=f, length=length)
+        else:
+            self._write_stream(image_id, header, data=data)
+
+        page_width, page_height = width * 72 / dpi, height * 72 / dpi
+        contents_id = self._new_id()
+        self._write_stream(contents_id, "", data=f"q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q".encode())
+        page_id = self._new_id()
+        self._write_object(page_id, (
+            f"<< /Type /Page /Parent {PAGES_ID} 0 R /MediaBox [0 0 {page_width:.2f} {page_height:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {contents_id} 0 R >>"
+        ))
+        self.pages.append(page_id)
+
+    def close(self) -> None:
+        """Write the page tree, catalog, cross-reference table and trailer."""
+        kids = " ".join(f"{page_id} 0 R" for page_id in self.pages)
+        self._write_object(PAGES_ID, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>")
+        self._write_object(CATALOG_ID, f"<< /Type /Catalog /Pages {PAGES_ID} 0 R >>")
+
+        xref_offset = self.output.tell()
+        size = self._next_id
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        lines += [f"{self.offsets[obj_id]:010d} 00000 n \n" for obj_id in range(1, size)]
+        lines.append(f"trailer\n<< /Size {size} /Root {CATALOG_ID} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self.output.write("".join(lines).encode())
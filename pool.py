@@ -0,0 +1,241 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import selenium.webdriver as driver
+from selenium.common.exceptions import WebDriverException
+
+import config
+import logger
+from metrics import browser_start_seconds, page_load_seconds
+
+log = logger.get_logger(__name__)
+
+
+class PoolExhaustedError(Exception):
+    """Raised when no browser becomes available before the checkout timeout."""
+
+
+@dataclass
+class PooledDriver:
+    """A browser owned by the pool and leased to one scraper at a time."""
+    driver: driver.Firefox
+    created_at: float = field(default_factory=time.monotonic)
+    pages: int = 0
+
+    def get(self, url: str) -> None:
+        self.pages += 1
+        with page_load_seconds.time(backend="selenium"):
+            self.driver.get(url)
+
+
+def _launch_driver() -> driver.Firefox:
+    options = driver.FirefoxOptions()
+    options.add_argument("--headless")
+    return driver.Firefox(options)
+
+
+def _children(pid: int) -> list[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+def _rss_mb(pid: int) -> float:
+    """Resident memory of a process and all of its descendants, in MB (0 if unknown)."""
+    total_kb = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+        stack.extend(_children(current))
+    return total_kb / 1024
+
+
+class BrowserPool:
+    """Bounded pool of long-lived headless Firefox instances.
+
+    Browsers are checked out for the duration of one scraping task and checked
+    back in afterwards. On checkin they are health checked and recycled once
+    they have served `max_pages` pages or grown above `max_memory_mb`.
+    """
+
+    def __init__(self, min_size: int, max_size: int, max_pages: int, max_memory_mb: int,
+                 checkout_timeout: float, factory=_launch_driver) -> None:
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.checkout_timeout = checkout_timeout
+        self._factory = factory
+
+        self._idle: list[PooledDriver] = []
+        self._size = 0  # idle + leased browsers
+        self._cond = threading.Condition()
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def warm_up(self) -> None:
+        """Launch browsers until at least `min_size` are alive."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                pooled = self._launch()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                log.exception("Could not launch a browser while warming up the pool.")
+                return
+            with self._cond:
+                self._idle.append(pooled)
+                self._cond.notify()
+
+    def checkout(self, timeout: float | None = None) -> PooledDriver:
+        """Lease a healthy browser, launching one if the pool is below `max_size`.
+
+        Raises:
+            PoolExhaustedError: if every browser stays leased for `timeout` seconds.
+        """
+        deadline = time.monotonic() + (self.checkout_timeout if timeout is None else timeout)
+        while True:
+            launch = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolExhaustedError("The browser pool is closed.")
+                    if self._idle:
+                        pooled = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        launch = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolExhaustedError(f"No browser available after waiting, {self._size} leased.")
+                    self._cond.wait(remaining)
+
+            if launch:
+                try:
+                    return self._launch()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(pooled):
+                return pooled
+            log.warning("Discarding an unhealthy browser from the pool.")
+            self._discard(pooled)
+
+    def checkin(self, pooled: PooledDriver) -> None:
+        """Give a leased browser back to the pool, recycling it if needed."""
+        reason = self._recycle_reason(pooled)
+        if reason:
+            log.info(f"Recycling browser: {reason}.")
+            self._discard(pooled)
+            if not self._closed:
+                threading.Thread(target=self.warm_up, daemon=True).start()
+            return
+
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    @contextmanager
+    def lease(self, timeout: float | None = None):
+        pooled = self.checkout(timeout)
+        try:
+            yield pooled
+        finally:
+            self.checkin(pooled)
+
+    def close(self) -> None:
+        """Quit all idle browsers. Leased ones are quit when they are checked in."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+        log.info("Browser pool closed.")
+
+    def _launch(self) -> PooledDriver:
+        started = time.monotonic()
+        pooled = PooledDriver(self._factory())
+        browser_start_seconds.observe(time.monotonic() - started)
+        log.info(f"Launched a browser in {time.monotonic() - started:.2f}s ({self._size}/{self.max_size} in pool).")
+        return pooled
+
+    def _discard(self, pooled: PooledDriver) -> None:
+        try:
+            pooled.driver.quit()
+        except Exception as e:
+            log.warning(f"Error while quitting a browser: {e}")
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, pooled: PooledDriver) -> bool:
+        try:
+            pooled.driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def _recycle_reason(self, pooled: PooledDriver) -> str | None:
+        if self._closed:
+            return "pool closed"
+        if pooled.pages >= self.max_pages:
+            return f"served {pooled.pages} pages"
+        try:
+            # drop the previous page so an idle browser holds as little memory as possible
+            pooled.driver.get("about:blank")
+        except WebDriverException:
+            return "unhealthy"
+        if self.max_memory_mb:
+            rss = self._memory_mb(pooled)
+            if rss > self.max_memory_mb:
+                return f"using {rss:.0f}MB"
+        return None
+
+    def _memory_mb(self, pooled: PooledDriver) -> float:
+        try:
+            return _rss_mb(pooled.driver.service.process.pid)
+        except AttributeError:
+            return 0
+
+
+# global browser pool, browsers are only launched on warm up or first checkout
+browser_pool = BrowserPool(
+    min_size=config.BROWSER_POOL_MIN_SIZE,
+    max_size=config.BROWSER_POOL_MAX_SIZE,
+    max_pages=config.BROWSER_MAX_PAGES,
+    max_memory_mb=config.BROWSER_MAX_MEMORY_MB,
+    checkout_timeout=config.BROWSER_CHECKOUT_TIMEOUT,
+)
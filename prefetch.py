@@ -0,0 +1,75 @@
+import asyncio
+
+import config
+import logger
+from cache import chapter_cache
+from chapters import prefetch_chapter_pdf
+from executors import run_db
+from jobs import JobCancelled, QueueFullError
+from scraper import Chapter, Manga
+
+log = logger.get_logger(__name__)
+
+
+class Prefetcher:
+    """Builds the PDFs of newly detected chapters in the background, ready for instant delivery.
+
+    Only mangas with at least `min_subscribers` subscribers are prefetched. At
+    most `concurrency` builds are queued at once, on the low priority lane of
+    the download queue, and none starts while unrequested prefetched PDFs
+    already take `max_bytes` of the chapter cache.
+    """
+
+    def __init__(self, enabled: bool, concurrency: int, max_bytes: int, min_subscribers: int) -> None:
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.min_subscribers = min_subscribers
+        self.prefetched = 0
+        self.skipped = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    def wants(self, subscribers: int) -> bool:
+        return self.enabled and subscribers >= self.min_subscribers
+
+    def schedule(self, manga: Manga, chapters: list[Chapter]) -> None:
+        loop = asyncio.get_running_loop()
+        for chapter in chapters:
+            task = loop.create_task(self._prefetch(manga, chapter))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _prefetch(self, manga: Manga, chapter: Chapter) -> None:
+        async with self._semaphore:
+            if await run_db(chapter_cache.prefetched_size) >= self.max_bytes:
+                self.skipped += 1
+                log.info(f"Prefetch budget is full, not prefetching {chapter.url}")
+                return
+            try:
+                entry = await prefetch_chapter_pdf(chapter.url, f"{manga.title} - {chapter.title}.pdf")
+            except QueueFullError:
+                self.skipped += 1
+                log.info(f"Download queue is busy, not prefetching {chapter.url}")
+                return
+            except JobCancelled:
+                return
+            except Exception as e:
+                log.warning(f"Prefetch of {chapter.url} failed: {e}")
+                return
+            if entry:
+                self.prefetched += 1
+                log.info(f"Prefetched {entry.filename}")
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# global prefetcher, fed by the notifier
+prefetcher = Prefetcher(
+    enabled=bool(config.PREFETCH_ENABLED),
+    concurrency=config.PREFETCH_CONCURRENCY,
+    max_bytes=config.PREFETCH_MAX_MB * 1024 * 1024,
+    min_subscribers=config.PREFETCH_MIN_SUBSCRIBERS,
+)
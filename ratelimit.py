@@ -0,0 +1,285 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterator
+from urllib.parse import urlparse
+
+import config
+import logger
+from metrics import adaptive_in_flight, adaptive_limit, circuit_opened, circuit_state
+
+log = logger.get_logger(__name__)
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # waiters queue up on the lock, so tokens are handed out in FIFO order
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """One token bucket per host, created on first use."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets: dict[str, TokenBucket] = {}
+
+    async def acquire(self, url: str) -> None:
+        host = urlparse(url).netloc
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = TokenBucket(self.rate, self.capacity)
+        await bucket.acquire()
+
+
+# global limiter for page requests to the scraped site
+host_limiter = HostRateLimiter(config.HOST_RATE_LIMIT, config.HOST_RATE_BURST)
+
+
+class CircuitOpenError(Exception):
+    """The host failed too often lately, requests to it fail fast until it is probed again."""
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit on the requests to one host, with a circuit breaker.
+
+    Every request holds a slot from `acquire` to `release`. The limit grows by
+    one per `limit` healthy responses, and is multiplied by `backoff` on a 429,
+    a 5xx, a network error or a response slower than `latency_factor` times the
+    usual latency, at most once per round trip. After `failure_threshold`
+    failures in a row the breaker opens and requests raise CircuitOpenError
+    for `open_seconds`, then a single probe decides whether it closes again.
+
+    Slots are taken from download threads as well as from the event loop, so
+    the state is guarded by a thread lock and waiting works in both worlds.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, name: str, initial: float, minimum: float, maximum: float, backoff: float,
+                 latency_factor: float, failure_threshold: int, open_seconds: float) -> None:
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.state = self.CLOSED
+        self.failures = 0  # in a row
+        self.latency: float | None = None  # moving average of healthy responses
+        self._opened_at = 0.0
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._publish()
+
+    def _try_acquire(self) -> bool:
+        """Take a slot if one is free, under the lock. Raises CircuitOpenError."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                raise CircuitOpenError(f"Circuit of {self.name} is open")
+            self.state = self.HALF_OPEN
+            log.info(f"Circuit of {self.name} is half open, probing")
+        if self.state == self.HALF_OPEN:
+            if self.in_flight:
+                raise CircuitOpenError(f"Circuit of {self.name} is half open, waiting for its probe")
+        elif self.in_flight >= max(1, int(self.limit)):
+            return False
+        self.in_flight += 1
+        return True
+
+    def acquire_blocking(self) -> float:
+        """Wait for a slot from a worker thread, returning the monotonic time it was granted."""
+        with self._lock:
+            while not self._try_acquire():
+                self._released.wait()
+        return time.monotonic()
+
+    async def acquire(self) -> float:
+        """Wait for a slot on the event loop, returning the monotonic time it was granted."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return time.monotonic()
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                raise
+
+    def release(self, started: float, outcome: str) -> None:
+        """Give a slot back with the outcome of its request: "ok", "throttled" (429), "overload" (5xx), "error"
+        or "ignored" when the request failed for a local reason and says nothing about the host.
+
+        Only overloads and errors count towards opening the breaker, a 429 just slows down.
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._lock:
+            self.in_flight -= 1
+            if outcome == "ok" and self.latency is not None and latency > self.latency_factor * self.latency:
+                outcome = "slow"
+            if outcome == "ignored":
+                # nothing learned about the host, a half open circuit is probed by the next request
+                pass
+            elif outcome == "ok":
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.failures = 0
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    log.info(f"Circuit of {self.name} closed")
+            else:
+                # requests sent before the last decrease saw the old limit, they do not count twice
+                if started >= self._decreased_at:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._decreased_at = now
+                if outcome == "slow":
+                    # still a response, the moving average follows a slower host
+                    self.latency = 0.9 * self.latency + 0.1 * latency
+                elif outcome != "throttled":
+                    self.failures += 1
+                    if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                        self._open(now)
+            self._publish()
+            waiters, self._async_waiters = self._async_waiters, []
+            self._released.notify_all()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _open(self, now: float) -> None:
+        if self.state != self.OPEN:
+            circuit_opened.inc(host=self.name)
+            log.warning(f"Circuit of {self.name} opened after {self.failures} failures, "
+                        f"failing fast for {self.open_seconds:g}s")
+        self.state = self.OPEN
+        self._opened_at = now
+
+    def _publish(self) -> None:
+        adaptive_limit.set(self.limit, host=self.name)
+        adaptive_in_flight.set(self.in_flight, host=self.name)
+        circuit_state.set((self.CLOSED, self.HALF_OPEN, self.OPEN).index(self.state), host=self.name)
+
+    def timeout(self, minimum: float, maximum: float) -> float:
+        """How long a request to the host can be waited for, from its usual latency."""
+        if self.latency is None:
+            return maximum
+        return min(maximum, max(minimum, self.latency_factor * self.latency))
+
+    @contextmanager
+    def slot(self, ignored: tuple[type[Exception], ...] = ()) -> Iterator["Slot"]:
+        """Hold a slot from a worker thread.
+
+        The outcome is "ok" unless set on the slot, "error" when the block
+        raises, or "ignored" when it raises one of the `ignored` exceptions.
+        """
+        slot = Slot(self.acquire_blocking())
+        try:
+            yield slot
+        except ignored:
+            slot.outcome = "ignored"
+            raise
+        except Exception:
+            slot.outcome = "error"
+            raise
+        finally:
+            self.release(slot.started, slot.outcome)
+
+    @asynccontextmanager
+    async def async_slot(self, ignored: tuple[type[Exception], ...] = ()) -> AsyncIterator["Slot"]:
+        """Hold a slot on the event loop, like `slot`."""
+        slot = Slot(await self.acquire())
+        try:
+            yield slot
+        except ignored:
+            slot.outcome = "ignored"
+            raise
+        except Exception:
+            slot.outcome = "error"
+            raise
+        finally:
+            self.release(slot.started, slot.outcome)
+
+
+@dataclass
+class Slot:
+    started: float
+    outcome: str = "ok"
+
+    def record_status(self, status_code: int) -> None:
+        """Classify an HTTP response: 429 asks to slow down, a 5xx means the host is overloaded."""
+        if status_code == 429:
+            self.outcome = "throttled"
+        elif status_code >= 500:
+            self.outcome = "overload"
+        else:
+            self.outcome = "ok"
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdaptiveHostLimiter:
+    """One AdaptiveLimiter per host, created on first use, shared by scraping and downloads."""
+
+    def __init__(self, **settings) -> None:
+        self.settings = settings
+        self.limiters: dict[str, AdaptiveLimiter] = {}
+        self._lock = threading.Lock()
+
+    def for_url(self, url: str, kind: str = "http") -> AdaptiveLimiter:
+        """The limiter of the host of `url`. Browser page loads are much slower than
+        plain requests, so each `kind` of client gets its own limiter per host."""
+        name = urlparse(url).netloc if kind == "http" else f"{kind}/{urlparse(url).netloc}"
+        with self._lock:
+            limiter = self.limiters.get(name)
+            if limiter is None:
+                limiter = self.limiters[name] = AdaptiveLimiter(name, **self.settings)
+        return limiter
+
+
+# global adaptive concurrency limits, per host of the scraped site and its image servers
+adaptive_limiter = AdaptiveHostLimiter(
+    initial=config.ADAPTIVE_INITIAL,
+    minimum=config.ADAPTIVE_MIN,
+    maximum=config.ADAPTIVE_MAX,
+    backoff=config.ADAPTIVE_BACKOFF,
+    latency_factor=config.ADAPTIVE_LATENCY_FACTOR,
+    failure_threshold=config.BREAKER_FAILURES,
+    open_seconds=config.BREAKER_OPEN_SECONDS,
+)
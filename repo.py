@@ -1,8 +1,16 @@
-from db import MangaRepository, UserRepository, get_connection, ChapterRepository
+import config
+from db import MangaRepository, UserRepository, get_database, ChapterRepository, ChapterCacheRepository, OutboxRepository, DigestRepository, CatalogRepository, LookupCacheRepository, LeaseRepository, PageCacheRepository
 
-connection = get_connection()
+database = get_database()
 
 # global manga repository instance
-mangaRepo = MangaRepository(connection)
-userRepo = UserRepository(connection)
-chapterRepo = ChapterRepository(connection)
\ No newline at end of file
+mangaRepo = MangaRepository(database)
+userRepo = UserRepository(database)
+chapterRepo = ChapterRepository(database)
+chapterCacheRepo = ChapterCacheRepository(database)
+pageCacheRepo = PageCacheRepository(database)
+outboxRepo = OutboxRepository(database)
+digestRepo = DigestRepository(database)
+catalogRepo = CatalogRepository(database)
+lookupCacheRepo = LookupCacheRepository(database)
+leaseRepo = LeaseRepository(database, config.NOTIFIER_SHARDS)
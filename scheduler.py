@@ -0,0 +1,154 @@
+import bisect
+import heapq
+import statistics
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterable
+
+import config
+import logger
+
+log = logger.get_logger(__name__)
+
+# only the most recent releases are used to estimate the cadence
+HISTORY_SIZE = 10
+
+
+@dataclass
+class PollState:
+    releases: list[float] = field(default_factory=list)  # release timestamps, oldest first
+    misses: int = 0  # consecutive checks without a release while dormant
+    next_check: float = 0
+
+    def add_release(self, published_at: float) -> bool:
+        """Insert a release in the history, returns False if it was already known."""
+        if published_at in self.releases:
+            return False
+        bisect.insort(self.releases, published_at)
+        del self.releases[:-HISTORY_SIZE]
+        return True
+
+    @property
+    def cadence(self) -> float | None:
+        """Median time between releases, None until two releases are known."""
+        if len(self.releases) < 2:
+            return None
+        return statistics.median(b - a for a, b in zip(self.releases, self.releases[1:]))
+
+
+class PollScheduler:
+    """Decides when each manga should be checked next, based on its release history.
+
+    Mangas live in a priority queue ordered by their next check time. A manga
+    is polled every `min_interval` inside the window around its expected next
+    release, waits for the window otherwise, and is backed off exponentially
+    (up to `max_interval`) once it has been silent for `dormant_factor` times
+    its usual cadence.
+    """
+
+    def __init__(self, min_interval: float, default_interval: float, max_interval: float,
+                 window_fraction: float, dormant_factor: float, dormant_after: float) -> None:
+        self.min_interval = min_interval
+        self.default_interval = default_interval
+        self.max_interval = max_interval
+        self.window_fraction = window_fraction
+        self.dormant_factor = dormant_factor
+        self.dormant_after = dormant_after
+
+        self.states: dict[str, PollState] = {}
+        self._heap: list[tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def sync(self, manga_urls: Iterable[str], now: float | None = None) -> list[str]:
+        """Track exactly `manga_urls`. New mangas are due right away and are returned."""
+        now = time.time() if now is None else now
+        manga_urls = set(manga_urls)
+        for url in self.states.keys() - manga_urls:
+            del self.states[url]  # its heap entry is skipped when popped
+
+        new_urls = [url for url in manga_urls if url not in self.states]
+        for url in new_urls:
+            self.states[url] = PollState()
+            self._push(url, now)
+        return new_urls
+
+    def learn(self, history: dict[str, list[datetime]]) -> None:
+        """Seed release history, e.g. from the database after `sync` returned new mangas."""
+        for url, releases in history.items():
+            state = self.states.get(url)
+            if state is None:
+                continue
+            for published_at in releases:
+                state.add_release(published_at.timestamp())
+
+    def due(self, now: float | None = None) -> list[str]:
+        """Pop every manga whose check time has come."""
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            next_check, url = heapq.heappop(self._heap)
+            state = self.states.get(url)
+            # stale entry of a removed or rescheduled manga
+            if state is None or state.next_check != next_check:
+                continue
+            due.append(url)
+        return due
+
+    def record_check(self, manga_url: str, published_at: datetime | None = None, now: float | None = None) -> float:
+        """Reschedule a manga after a check, `published_at` being the release it found if any."""
+        now = time.time() if now is None else now
+        state = self.states.get(manga_url)
+        if state is None:
+            return 0
+
+        if published_at is not None:
+            state.add_release(published_at.timestamp())
+            state.misses = 0
+        interval = self.next_interval(state, now)
+        self._push(manga_url, now + interval)
+        return interval
+
+    def next_interval(self, state: PollState, now: float) -> float:
+        if not state.releases:
+            return self.default_interval
+
+        silence = now - state.releases[-1]
+        cadence = state.cadence
+        dormant_after = self.dormant_after if cadence is None else self.dormant_factor * cadence
+
+        if silence > dormant_after:
+            interval = self.default_interval * 2 ** state.misses
+            state.misses += 1
+            return min(self.max_interval, interval)
+        state.misses = 0
+
+        if cadence is None:
+            return self.default_interval
+
+        expected = state.releases[-1] + cadence
+        window = max(self.window_fraction * cadence, self.min_interval)
+        if now < expected - window:
+            # sleep until the release window opens
+            return min(self.max_interval, max(self.min_interval, expected - window - now))
+        if now <= expected + window:
+            return self.min_interval
+        # late release, keep checking at the normal pace
+        return self.default_interval
+
+    def _push(self, manga_url: str, next_check: float) -> None:
+        self.states[manga_url].next_check = next_check
+        heapq.heappush(self._heap, (next_check, manga_url))
+
+
+# global scheduler instance used by the notifier job
+poll_scheduler = PollScheduler(
+    min_interval=config.POLL_MIN_INTERVAL,
+    default_interval=config.POLL_DEFAULT_INTERVAL,
+    max_interval=config.POLL_MAX_INTERVAL,
+    window_fraction=config.POLL_WINDOW_FRACTION,
+    dormant_factor=config.POLL_DORMANT_FACTOR,
+    dormant_after=config.POLL_DORMANT_AFTER,
+)
@@ -1,13 +1,23 @@
 from dataclasses import dataclass
 import datetime
+import config
 import logger as logger
-import selenium.webdriver as driver
 import selenium.webdriver.common.by as by
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
+from metrics import scraper_errors, scraper_seconds, timed
+from pool import BrowserPool, browser_pool
+from ratelimit import adaptive_limiter
 
 log = logger.get_logger(__name__)
 
+# the innermost divs of #chapter-list holding both a chapter link and its date
+CHAPTER_ROWS_XPATH = (
+    "//*[@id='chapter-list']//div[.//time[@datetime] and .//a[@href]]"
+    "[not(.//div[.//time[@datetime] and .//a[@href]])]"
+)
+
 
 @dataclass
 class Chapter:
@@ -26,22 +36,47 @@ class Manga:
 
 
 class MangaScraper:
+    """Scrapes WeebCentral with a browser leased from the pool until `close()` is called."""
 
-    def __init__(self):
-        options = driver.FirefoxOptions()
-        options.add_argument("--headless")
-
-        self.driver = driver.Firefox(options)
-        self.homepage = "https://weebcentral.com/"
+    def __init__(self, pool: BrowserPool = browser_pool):
+        self.pool = pool
+        self.lease = pool.checkout()
+        self.driver = self.lease.driver
+        self.homepage = config.WEEBCENTRAL_URL
         self.mangas_container_xpath = "/html/body/header/section[1]/div[2]/section/div[2]"
-    
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _load(self, url: str) -> None:
+        """Load a page on the leased browser, holding a slot of the adaptive limiter of its host meanwhile.
+
+        Only the page load is measured, waiting for a scrape thread or a free
+        browser is local and says nothing about the host.
+        """
+        with adaptive_limiter.for_url(url, "selenium").slot():
+            self.lease.get(url)
+
+    @timed(scraper_seconds, scraper_errors, backend="selenium", operation="go_to_homepage")
     def go_to_homepage(self):
-        self.driver.get(self.homepage)
+        self._load(self.homepage)
 
+    @timed(scraper_seconds, scraper_errors, backend="selenium", operation="get_queried_mangas")
     def get_queried_mangas(self, query: str) -> list[Manga]:
         self.driver.find_element(by.By.ID, "quick-search-input").send_keys(query)
-        wait = WebDriverWait(self.driver, 5)
-        container = wait.until(EC.presence_of_element_located((by.By.XPATH, self.mangas_container_xpath)))
+        # as long as the site usually takes to answer, instead of a fixed guess
+        timeout = adaptive_limiter.for_url(self.homepage, "selenium").timeout(config.SEARCH_WAIT_MIN, config.SEARCH_WAIT_MAX)
+        try:
+            container = WebDriverWait(self.driver, timeout).until(
+                EC.presence_of_element_located((by.By.XPATH, self.mangas_container_xpath))
+            )
+        except TimeoutException:
+            # the results box is not rendered when nothing matches
+            log.info(f"No search results for {query!r} within {timeout:.1f}s")
+            return []
         a_list = container.find_elements(by.By.TAG_NAME, "a")
         mangas = []
         for a in a_list:
@@ -50,23 +85,36 @@ class MangaScraper:
             mangas.append(Manga(title=manga_title, url=manga_url))
         return mangas
 
-    def get_last_chapter(self, manga: Manga) -> Chapter:
-        self.driver.get(manga.url)
-        last_chapter_div = self.driver.find_element(by.By.ID, "chapter-list").find_element(by.By.TAG_NAME, "div")
-        date = last_chapter_div.find_element(by.By.TAG_NAME, "time").get_attribute("datetime")
+    @staticmethod
+    def _chapter_from_div(chapter_div) -> Chapter:
+        date = chapter_div.find_element(by.By.TAG_NAME, "time").get_attribute("datetime")
         datetime_obj = datetime.datetime.fromisoformat(date)   
-        url = last_chapter_div.find_element(by.By.TAG_NAME, "a").get_attribute("href")   
-        title = last_chapter_div.find_element(by.By.TAG_NAME, "a").text.split("\n")[0].strip()
-        last_chapter = Chapter(
+        url = chapter_div.find_element(by.By.TAG_NAME, "a").get_attribute("href")   
+        title = chapter_div.find_element(by.By.TAG_NAME, "a").text.split("\n")[0].strip()
+        return Chapter(
             title=title,
             url=url,
             published_at=datetime_obj
         )
+
+    @timed(scraper_seconds, scraper_errors, backend="selenium", operation="get_last_chapter")
+    def get_last_chapter(self, manga: Manga) -> Chapter:
+        self._load(manga.url)
+        last_chapter_div = self.driver.find_element(by.By.ID, "chapter-list").find_element(by.By.TAG_NAME, "div")
+        last_chapter = self._chapter_from_div(last_chapter_div)
         if not manga.last_chapter:
             manga.add_chapter(last_chapter)
         
         return last_chapter
+
+    @timed(scraper_seconds, scraper_errors, backend="selenium", operation="get_chapters")
+    def get_chapters(self, manga: Manga) -> list[Chapter]:
+        """Get every chapter listed on the manga page, newest first."""
+        self._load(manga.url)
+        chapter_divs = self.driver.find_elements(by.By.XPATH, CHAPTER_ROWS_XPATH)
+        return [self._chapter_from_div(chapter_div) for chapter_div in chapter_divs]
     
+    @timed(scraper_seconds, scraper_errors, backend="selenium", operation="get_data_from_chapter_url")
     def get_data_from_chapter_url(self, chapter_url: str) -> tuple[str, str]:
         """Extract manga and chapter titles from a chapter URL.
         Args:
@@ -74,15 +122,15 @@ class MangaScraper:
         Returns:
             tuple[str, str]: A tuple containing the manga title and chapter title.
         """
-        self.driver.get(chapter_url)
+        self._load(chapter_url)
         manga_title = self.driver.find_element(by.By.XPATH, "/html/body/main/section[1]/div/div[1]/a/div").text
         chapter_title = self.driver.find_element(by.By.XPATH, "/html/body/main/section[1]/div/div[1]/button[1]").text
         return manga_title, chapter_title
 
     
-    # TODO change to chapter_url
-    def get_chapter_image_urls(self, chapter: Chapter) -> list[str]:
-        self.driver.get(chapter.url)
+    @timed(scraper_seconds, scraper_errors, backend="selenium", operation="get_chapter_image_urls")
+    def get_chapter_image_urls(self, chapter_url: str) -> list[str]:
+        self._load(chapter_url)
         xpath_container = "/html/body/main/section[3]"
         container = self.driver.find_element(by.By.XPATH, xpath_container)
         image_elements = container.find_elements(by.By.TAG_NAME, "img")
@@ -90,5 +138,8 @@ class MangaScraper:
         return image_urls
 
     def close(self):
-        print("Closing the browser...")
-        self.driver.quit()
+        """Return the browser to the pool. Safe to call more than once."""
+        if self.lease is None:
+            return
+        self.pool.checkin(self.lease)
+        self.lease = None
@@ -0,0 +1,47 @@
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+from optimizer import OptimizeSettings, optimize_page
+
+
+def _page(path: str, width: int, height: int, format: str, quality: int = 95) -> None:
+    rng = random.Random(path)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + rng.randrange(5, 80), y + rng.randrange(5, 80)), fill=color)
+    if format == "JPEG":
+        image.save(path, format, quality=quality)
+    else:
+        image.save(path, format)
+
+
+def test_png_within_width_is_converted_to_jpeg(tmp_path):
+    path = str(tmp_path / "0001.img")
+    _page(path, 800, 1200, "PNG")
+    settings = OptimizeSettings(max_width=1200, quality=80, min_quality=40, slice_height=4000, page_budget=0)
+
+    page = optimize_page(path, settings)
+
+    assert page.paths != [path]
+    for part_path in page.paths:
+        with Image.open(part_path) as part:
+            assert part.format == "JPEG"
+            assert part.size == (800, 1200)
+
+
+def test_jpeg_over_budget_is_brought_under_it(tmp_path):
+    path = str(tmp_path / "0001.img")
+    _page(path, 800, 1200, "JPEG")
+    budget = os.path.getsize(path) // 3
+    settings = OptimizeSettings(max_width=1200, quality=80, min_quality=40, slice_height=4000, page_budget=budget)
+
+    page = optimize_page(path, settings)
+
+    assert page.paths != [path]
+    assert page.size <= budget
+    assert sum(os.path.getsize(part_path) for part_path in page.paths) == page.size
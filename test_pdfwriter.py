@@ -0,0 +1,25 @@
+import io
+
+import pikepdf
+import pytest
+from PIL import Image, UnidentifiedImageError
+
+from pdfwriter import PdfWriter
+
+
+def test_invalid_image_leaves_a_valid_pdf(tmp_path):
+    invalid = tmp_path / "0001.img"
+    invalid.write_bytes(b"<html><body>Not an image</body></html>")
+    valid = tmp_path / "0002.img"
+    Image.new("RGB", (300, 400), "red").save(valid, "JPEG")
+    output = io.BytesIO()
+
+    writer = PdfWriter(output)
+    with pytest.raises(UnidentifiedImageError):
+        writer.add_image(str(invalid))
+    writer.add_image(str(valid))
+    writer.close()
+
+    output.seek(0)
+    with pikepdf.open(output) as pdf:
+        assert len(pdf.pages) == 1
@@ -1,12 +1,28 @@
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import ContextTypes, ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters
 from enum import Enum, auto
+import asyncio
+import functools
+import time
+import uuid
+from urllib.parse import urljoin
 
+import config
 import logger as logger
-from scraper import Chapter, MangaScraper, Manga
-import downloader
-from downloader import download_pdf 
-from repo import mangaRepo, userRepo, chapterRepo
+from logger import correlation_id
+from metrics import handler_errors, handler_seconds, timed
+from scraper import Chapter, Manga
+from backends import backend
+from notifier import RunSummary, format_digest, run_checks
+from executors import run_db
+from cache import chapter_cache
+from catalog import catalog
+from chapters import download_queue, request_chapter_pdf
+from downloader import PageUnavailable
+from jobs import JobCancelled, QueueFullError, Ticket
+from dispatcher import OutboxMessage, dispatcher
+from repo import mangaRepo, userRepo, chapterRepo, digestRepo
 from sqlite3 import Error as DbError
 
 log = logger.get_logger(__name__)
@@ -22,13 +38,176 @@ class ManageMangaConversationStates(Enum):
     REMOVE_MANGA = auto()
 
 
+# ====== HELPERS ======
+def instrumented(handler):
+    """Time a handler or job, and tag the log lines of each update or job run with their own correlation id."""
+    timed_handler = timed(handler_seconds, handler_errors, handler=handler.__name__)(handler)
+
+    @functools.wraps(handler)
+    async def wrapper(*args):
+        update = args[0]
+        if isinstance(update, Update):
+            token = correlation_id.set(f"update-{update.update_id}")
+        else:
+            token = correlation_id.set(f"{handler.__name__}-{uuid.uuid4().hex[:8]}")
+        try:
+            return await timed_handler(*args)
+        finally:
+            correlation_id.reset(token)
+    return wrapper
+
+async def reply_with_file_id(message: Message, chapter_url: str) -> bool:
+    """Resend an already uploaded chapter PDF by its file_id. Returns False if there is none."""
+    file_id = await run_db(chapterRepo.find_file_id, chapter_url)
+    if not file_id:
+        return False
+    try:
+        await message.reply_document(document=file_id, reply_markup=ReplyKeyboardRemove())
+        return True
+    except BadRequest as e:
+        log.warning(f"Stored file_id of {chapter_url} was rejected, uploading it again: {e}")
+        await run_db(chapterRepo.delete_file_id, chapter_url)
+        return False
+
+async def flush_digests() -> None:
+    """Queue one message per user for every digest whose window has passed."""
+    if config.NOTIFY_MODE != "digest":
+        return
+    digests = await run_db(digestRepo.find_due, time.time() - config.DIGEST_WINDOW)
+    if not digests:
+        return
+    messages = [
+        OutboxMessage(user_id, text)
+        for user_id, items in digests.items()
+        for text in format_digest(items)
+    ]
+    await dispatcher.enqueue_digests(
+        messages, [(user_id, item[2]) for user_id, items in digests.items() for item in items]
+    )
+    log.info(f"Queued {len(messages)} digest messages for {len(digests)} users")
+
+def download_status(ticket: Ticket) -> str:
+    position = download_queue.position(ticket)
+    if position:
+        return f"You are #{position} in the download queue. Send /cancel to stop waiting."
+    job = ticket.job
+    if job.pages_total:
+        return f"Downloading... {job.pages_done}/{job.pages_total} pages"
+    return "Downloading..."
+
+async def show_progress(status: Message, ticket: Ticket) -> None:
+    """Edit the status message in place while the download is queued and running."""
+    text = status.text
+    while True:
+        await asyncio.sleep(config.DOWNLOAD_PROGRESS_INTERVAL)
+        new_text = download_status(ticket)
+        if new_text == text:
+            continue
+        try:
+            await status.edit_text(new_text)
+            text = new_text
+        except TelegramError as e:
+            log.warning(f"Could not update the download progress: {e}")
+
+async def reply_with_pdf(message: Message, chapter_url: str, filename: str, user_id: int) -> bool:
+    """Upload the PDF of a chapter, from the chapter cache or through the download queue, and remember its file_id.
+
+    Returns False, after telling the user why, when the PDF was not sent.
+    """
+    cached = await run_db(chapter_cache.open, chapter_url)
+    if cached:
+        log.info(f"Chapter cache hit for {chapter_url}")
+        pdf = cached[0]
+    else:
+        try:
+            ticket = request_chapter_pdf(chapter_url, filename, user_id)
+        except QueueFullError as e:
+            log.warning(f"Download of {chapter_url} refused: {e}")
+            await message.reply_text("Too many downloads are queued right now, please try again in a few minutes.",
+                                     reply_markup=ReplyKeyboardRemove())
+            return False
+
+        # let an idle worker pick the job up first, it is not queued then
+        await asyncio.sleep(0)
+        status = await message.reply_text(download_status(ticket), reply_markup=ReplyKeyboardRemove())
+        progress = asyncio.create_task(show_progress(status, ticket))
+        try:
+            entry = await download_queue.wait(ticket)
+        except JobCancelled:
+            await status.edit_text("Download cancelled.")
+            return False
+        except PageUnavailable as e:
+            log.warning(f"Download of {chapter_url} incomplete: {e}")
+            # the pages downloaded are cached, trying again only downloads the missing ones
+            await status.edit_text("Some pages could not be downloaded, please try again in a few minutes.")
+            return False
+        finally:
+            progress.cancel()
+        if entry is None:
+            await status.edit_text("No images found for the chapter.")
+            return False
+        await status.edit_text("Uploading...")
+        # every waiter gets its own handle on the cached file
+        pdf = open(entry.path, "rb")
+
+    with pdf:
+        sent = await message.reply_document(
+            document=pdf,
+            filename=filename,
+            reply_markup=ReplyKeyboardRemove()
+        )
+    await run_db(chapterRepo.save_file_id, chapter_url, sent.document.file_id)
+    return True
+
+async def deliver_download(message: Message, chapter_url: str, user_id: int) -> None:
+    """Send the chapter of a /download, in the background so the user can /cancel it meanwhile."""
+    try:
+        if await reply_with_file_id(message, chapter_url):
+            log.info(f"Chapter {chapter_url} was resent by file_id")
+            return
+
+        cached = await run_db(chapter_cache.get, chapter_url)
+        if cached:
+            filename = cached.filename
+        else:
+            chapter = await run_db(chapterRepo.find_chapter, chapter_url)
+            manga = await run_db(mangaRepo.find_manga_by_chapter_url, chapter_url) if chapter else None
+            if manga:
+                manga_title, chapter_title = manga.title, chapter.title
+            else:
+                # you have to scrape this chapter
+                manga_title, chapter_title = await backend.get_data_from_chapter_url(chapter_url)
+            filename = f"{manga_title} - {chapter_title}.pdf"
+
+        if await reply_with_pdf(message, chapter_url, filename, user_id):
+            log.info(f"Chapter {filename} was successfully downloaded")
+    except Exception as e:
+        log.error(f"Error downloading chapter: {e}")
+        await message.reply_text("An error occurred while downloading the chapter.")
+
+async def deliver_chapter(message: Message, manga: Manga, chapter: Chapter, user_id: int) -> None:
+    """Send a chapter chosen in /add, in the background so the user can /cancel it meanwhile."""
+    try:
+        sent = (
+            await reply_with_file_id(message, chapter.url)
+            or await reply_with_pdf(message, chapter.url, f"{manga.title} - {chapter.title}.pdf", user_id)
+        )
+        if sent:
+            log.info(f"Sent PDF for {manga.title} - {chapter.title}")
+    except Exception as e:
+        log.error(f"Error downloading chapter: {e}")
+        await message.reply_text("An error occurred while downloading the chapter.")
+
+
 # ====== COMMAND HANDLERS ======
+@instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     log.info(f"/start from {update.effective_user.name} ({user_id})")
-    userRepo.save_user(user_id)
+    await run_db(userRepo.save_user, user_id)
     await help(update, context)
 
+@instrumented
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     log.info(f"/help from {update.effective_user.name} ({update.effective_user.id})")
     await update.message.reply_text(
@@ -38,52 +217,30 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/add <manga_title> - Add a manga to your list\n"
         "/list - List your mangas. You can remove the chosen manga\n"
         "/download <chapter_url> - Download the requested chapter. Only WeebCentral urls are accepted \n"
-        "/cancel - Cancel the current operation\n"
+        "/cancel - Cancel the current operation and your downloads\n"
     )
 
+@instrumented
 async def download(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Download a chapter from WeebCentral."""
     log.info(f"/download from {update.effective_user.name} ({update.effective_user.id})")
     chapter_url = " ".join(context.args)
-    print(chapter_url)
+    log.debug(f"Requested chapter {chapter_url}")
     if not chapter_url:
         await update.message.reply_text("Please provide a chapter URL to download.")
         return
-    if not chapter_url.startswith("https://weebcentral.com/chapters"):
+    if not chapter_url.startswith(urljoin(config.WEEBCENTRAL_URL, "/chapters")):
         await update.message.reply_text("Invalid URL. Please provide a valid WeebCentral chapter URL.")
         return
-    try:
-        scraper = MangaScraper()
-
-        chapter = chapterRepo.find_chapter(chapter_url)
-        manga_title, chapter_title = None, None
-        if not chapter:
-            # you have to scrape this chapter
-            manga_title, chapter_title = scraper.get_data_from_chapter_url(chapter_url)
-
-        # TODO change
-        img_urls = scraper.get_chapter_image_urls(Chapter(
-            "NO TITLE",
-            chapter_url,
-            "NO DATETIME"
-        ))
-        img_bytes = download_pdf(img_urls)
-        await update.message.reply_document(
-            document=img_bytes,
-            filename=f"{manga_title} - {chapter_title}.pdf",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        log.info(f"Chapter {chapter_title} from the Manga {manga_title} was successfully downloaded")
-    except Exception as e:
-        log.error(f"Error downloading chapter: {e}")
-        await update.message.reply_text("An error occurred while downloading the chapter.")
-        return
-    finally:
-        scraper.close()
+
+    context.application.create_task(
+        deliver_download(update.message, chapter_url, update.effective_user.id), update=update
+    )
 
 
 
 # ====== ADD MANGA CONVERSATION ======
+@instrumented
 async def add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> AddMangaConversationStates | None:
     log.info(f"/add from {update.effective_user.name} ({update.effective_user.id})")
 
@@ -92,11 +249,9 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> AddMangaCon
         return
 
     query = " ".join(context.args)
-    scraper = MangaScraper()
 
     try:
-        scraper.go_to_homepage()
-        mangas = scraper.get_queried_mangas(query)
+        mangas = await catalog.search(query)
 
         if not mangas:
             await update.message.reply_text("No mangas found for your query.")
@@ -117,9 +272,8 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> AddMangaCon
     except Exception as e:
         log.error(f"Error in /add: {e}")
         await update.message.reply_text("An error occurred while processing your request.")
-    finally:
-        scraper.close()
 
+@instrumented
 async def choose_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> AddMangaConversationStates | None:
     user_input = update.message.text.strip()
     mangas: list[Manga] = context.user_data.get("mangas", [])
@@ -138,10 +292,8 @@ async def choose_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Ad
     log.info(f"Manga selected: {selected_manga.title}")
     await update.message.reply_text(f"You selected: {selected_manga.title}")
 
-    scraper = MangaScraper()
     try:
-        scraper.go_to_homepage()
-        last_chapter = scraper.get_last_chapter(selected_manga)
+        last_chapter = await backend.get_last_chapter(selected_manga)
 
         if not last_chapter:
             await update.message.reply_text("Could not retrieve the last chapter.")
@@ -163,7 +315,7 @@ async def choose_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Ad
 
         # Save manga to the database
         chat_id = update.effective_user.id
-        mangaRepo.save_manga(chat_id, selected_manga)
+        await run_db(mangaRepo.save_manga, chat_id, selected_manga)
 
         return AddMangaConversationStates.GET_LAST_CHAPTER
 
@@ -172,9 +324,8 @@ async def choose_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Ad
         await update.message.reply_text("An error occurred while retrieving the last chapter.")
     except DbError as e:
         await update.message.reply_text("An error occurred while saving the manga to the database.\nYou will not be notified about new chapters.")    
-    finally:
-        scraper.close()
 
+@instrumented
 async def get_last_chapter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     CHOICES = ["Download", "Read Online", "Do Nothing"]
     choice = update.message.text.strip()
@@ -199,25 +350,9 @@ async def get_last_chapter(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ConversationHandler.END
 
     if choice == "Download":
-        await update.message.reply_text("Downloading the last chapter...")
-        scraper = MangaScraper()
-        try:
-            image_urls = scraper.get_chapter_image_urls(chapter)
-        finally:
-            scraper.close()
-
-        if not image_urls:
-            await update.message.reply_text("No images found for the chapter.")
-            context.user_data.clear()
-            return ConversationHandler.END
-
-        pdf = downloader.download_pdf(image_urls)
-        await update.message.reply_document(
-            document=pdf,
-            filename=f"{manga.title} - {chapter.title}.pdf",
-            reply_markup=ReplyKeyboardRemove()
+        context.application.create_task(
+            deliver_chapter(update.message, manga, chapter, update.effective_user.id), update=update
         )
-        log.info(f"Sent PDF for {manga.title} - {chapter.title}")
 
     elif choice == "Read Online":
         await update.message.reply_text(chapter.url, reply_markup=ReplyKeyboardRemove())
@@ -232,10 +367,11 @@ async def get_last_chapter(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return ConversationHandler.END
 
 # ====== MANAGE MANGE CONVERSATION ======
+@instrumented
 async def list_mangas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> ManageMangaConversationStates | int | None:
     """List all mangas associated with the user and allow them to choose one to remove."""
     chat_id = update.effective_user.id
-    mangas = mangaRepo.find_all_mangas_by_chat_id(chat_id)
+    mangas = await run_db(mangaRepo.find_all_mangas_by_chat_id, chat_id)
 
     if not mangas:
         await update.message.reply_text(
@@ -257,6 +393,7 @@ async def list_mangas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Man
     )
     return ManageMangaConversationStates.REMOVE_MANGA
 
+@instrumented
 async def remove_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> ManageMangaConversationStates | int | None:
     """Remove the selected manga from the user's list."""
     user_input = update.message.text.strip()
@@ -282,7 +419,7 @@ async def remove_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Ma
         return
 
     try:
-        userRepo.delete_manga_of_user(chat_id, selected_manga.url)
+        await run_db(userRepo.delete_manga_of_user, chat_id, selected_manga.url)
         await update.message.reply_text(f"{selected_manga.title} has been removed from your list.")
     except DbError as e:
         log.error(f"Error removing manga: {e}")
@@ -293,41 +430,31 @@ async def remove_manga(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Ma
 
 
 
-async def notifier(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Notify all users about new chapters for their subscribed mangas."""
-    log.info("Running notifier job...")
-    scraper = MangaScraper()
-    # get all mangas from the database
-    mangas = mangaRepo.find_all_mangas()
-    
-    try:
-        for manga in mangas:
-            scraped_last_chapter = scraper.get_last_chapter(manga)
-            if scraped_last_chapter.url != manga.last_chapter.url:
-                log.info(f"New chapter found for {manga.title}: {scraped_last_chapter.title}")
-                manga.add_chapter(scraped_last_chapter)
-                # notify all users subscribed to this manga
-                user_ids = userRepo.find_user_ids_by_manga_url(manga.url)
-                for user_id in user_ids:
-                    context.bot.send_message(
-                        user_id=user_id,
-                        text=f"{scraped_last_chapter.url}\n"
-                    )
+@instrumented
+async def notifier(context: ContextTypes.DEFAULT_TYPE) -> RunSummary | None:
+    """Notify users about new chapters of the subscribed mangas that are due for a check.
 
-    except Exception as e:
-        log.error(f"Error in notifier: {e}")
-        return
-    finally:
-        scraper.close()
-    
+    Returns the summary of the run, None when no manga was due or worker.py
+    processes do the checks, in which case only the digests are sent from here.
+    """
+    summary = None if config.NOTIFIER_EXTERNAL else await run_checks()
+    await flush_digests()
+    return summary
 
 
+@instrumented
+async def crawl_catalog(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Grow and refresh the local catalog used by /add."""
+    await catalog.crawl()
 
 
+@instrumented
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(
-            "You'll be notified when a new chapter is available on WeebCentral.",
-            reply_markup=ReplyKeyboardRemove()
-    )
+    cancelled = download_queue.cancel(update.effective_user.id)
+    if cancelled:
+        text = f"Cancelled {cancelled} download{'s' if cancelled > 1 else ''}."
+    else:
+        text = "You'll be notified when a new chapter is available on WeebCentral."
+    await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
     context.user_data.clear()
     return ConversationHandler.END
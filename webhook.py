@@ -0,0 +1,196 @@
+"""Receives telegram updates by webhook instead of long polling.
+
+Telegram POSTs every update as JSON to WEBHOOK_URL, which a TLS reverse
+proxy forwards to http://WEBHOOK_HOST:WEBHOOK_PORT. A recorded update can be
+replayed locally with:
+
+    curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \\
+         -H "Content-Type: application/json" -d @update.json http://127.0.0.1:8443/<path>
+"""
+import asyncio
+import hmac
+import json
+import secrets
+import signal
+from urllib.parse import urlsplit
+
+import h11
+from telegram import Update
+from telegram.ext import Application
+
+import config
+import logger
+
+log = logger.get_logger(__name__)
+
+SECRET_HEADER = b"x-telegram-bot-api-secret-token"
+# telegram updates are a few KB, anything much larger is not one
+MAX_BODY_SIZE = 1024 * 1024
+READ_TIMEOUT = 60
+# telegram accepts at most this many webhook connections
+MAX_CONNECTIONS = 100
+
+
+class WebhookServer:
+    """Minimal HTTP/1.1 server, on asyncio streams and h11, feeding webhook updates to the application.
+
+    Requests without the secret token are refused. An update is acknowledged
+    as soon as it is handed to a processing task, and at most `max_in_flight`
+    updates are processed at once: past that the next request is only
+    answered when a slot frees up, which holds telegram back. Updates of one
+    chat are still processed one at a time, in the order they were received,
+    so the state of a conversation is never updated by two of them at once.
+    """
+
+    def __init__(self, application: Application, host: str, port: int, path: str, secret_token: str,
+                 max_in_flight: int) -> None:
+        self.application = application
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token.encode()
+        self.max_in_flight = max_in_flight
+
+        self.received = 0
+        self.rejected = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_pending: dict[int, int] = {}  # updates holding or waiting for each chat lock
+        self._tasks: set[asyncio.Task] = set()
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info(f"Listening for webhook updates on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # updates already acknowledged are not redelivered by telegram, finish them
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = h11.Connection(h11.SERVER)
+        try:
+            while True:
+                request, body = await self._read_request(connection, reader)
+                if request is None:
+                    return
+                status = await self._handle(request, body)
+                writer.write(connection.send(h11.Response(
+                    status_code=status, headers=[("Content-Length", "0"), ("Connection", "keep-alive")]
+                )))
+                writer.write(connection.send(h11.EndOfMessage()))
+                await writer.drain()
+                if connection.our_state is h11.MUST_CLOSE or connection.their_state is h11.MUST_CLOSE:
+                    return
+                connection.start_next_cycle()
+        except (h11.ProtocolError, ConnectionError, asyncio.TimeoutError) as e:
+            log.debug(f"Webhook connection closed: {e!r}")
+        finally:
+            writer.close()
+
+    async def _read_request(self, connection: h11.Connection,
+                            reader: asyncio.StreamReader) -> tuple[h11.Request | None, bytes]:
+        request, body = None, bytearray()
+        while True:
+            event = connection.next_event()
+            if event is h11.NEED_DATA:
+                data = await asyncio.wait_for(reader.read(64 * 1024), READ_TIMEOUT)
+                connection.receive_data(data)
+            elif isinstance(event, h11.Request):
+                request = event
+            elif isinstance(event, h11.Data):
+                body += event.data
+                if len(body) > MAX_BODY_SIZE:
+                    raise h11.RemoteProtocolError("request body too large")
+            elif isinstance(event, h11.EndOfMessage):
+                return request, bytes(body)
+            elif isinstance(event, h11.ConnectionClosed):
+                return None, b""
+
+    async def _handle(self, request: h11.Request, body: bytes) -> int:
+        if request.target.decode().split("?")[0] != self.path:
+            return 404
+        if request.method != b"POST":
+            return 405
+        token = dict(request.headers).get(SECRET_HEADER, b"")
+        if not hmac.compare_digest(token, self.secret_token):
+            self.rejected += 1
+            log.warning("Webhook request with a wrong secret token rejected")
+            return 403
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            log.warning(f"Invalid webhook update: {e}")
+            return 400
+
+        self.received += 1
+        await self._slots.acquire()
+        task = asyncio.get_running_loop().create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return 200
+
+    async def _process(self, update: Update) -> None:
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        try:
+            if chat_id is None:
+                await self.application.process_update(update)
+                return
+            lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+            self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+            try:
+                async with lock:
+                    await self.application.process_update(update)
+            finally:
+                self._chat_pending[chat_id] -= 1
+                # nobody else is queued on it, the next update of the chat starts a new one
+                if not self._chat_pending[chat_id]:
+                    del self._chat_pending[chat_id]
+                    del self._chat_locks[chat_id]
+        except Exception as e:
+            log.exception(f"Error processing update {update.update_id}: {e}")
+        finally:
+            self._slots.release()
+
+
+async def run_webhook(application: Application) -> None:
+    """Run the application on webhook updates until SIGINT or SIGTERM, the webhook counterpart of run_polling."""
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(
+        application,
+        host=config.WEBHOOK_HOST,
+        port=config.WEBHOOK_PORT,
+        path=urlsplit(config.WEBHOOK_URL).path or "/",
+        secret_token=secret_token,
+        max_in_flight=config.WEBHOOK_MAX_IN_FLIGHT,
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await server.start()
+        await application.bot.set_webhook(
+            config.WEBHOOK_URL,
+            secret_token=secret_token,
+            max_connections=min(MAX_CONNECTIONS, config.WEBHOOK_MAX_IN_FLIGHT),
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        await stop.wait()
+        log.info("Stopping the webhook server...")
+        await server.stop()
+        await application.stop()
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
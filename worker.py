@@ -0,0 +1,89 @@
+"""Checks mangas for new chapters apart from the telegram bot, so the checks scale out.
+
+    NOTIFIER_EXTERNAL=1 python main.py   # the bot only sends what the workers queue
+    python worker.py                     # as many times as needed
+
+Every worker holds leases on a share of the shards of the mangas table and
+checks only the mangas in them. New chapters go to the outbox and the digest
+table in the shared database, which the bot drains.
+"""
+import asyncio
+import os
+import signal
+import socket
+import uuid
+
+import config
+import executors
+import logger
+from backends import backend
+from chapters import download_queue
+from optimizer import page_optimizer
+from leases import ShardLeases, create_shard_leases
+from logger import correlation_id
+from notifier import run_checks
+from pool import browser_pool
+from prefetch import prefetcher
+from repo import database
+
+log = logger.get_logger(__name__)
+
+
+class Worker:
+    def __init__(self, leases: ShardLeases, tick: float, heartbeat: float) -> None:
+        self.leases = leases
+        self.tick = tick
+        self.heartbeat = heartbeat
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self.leases.rebalance()
+            except Exception as e:
+                # owns() turns False once the leases could not be renewed for their whole ttl
+                log.error(f"Heartbeat of worker {self.leases.owner} failed: {e}")
+
+    async def run(self) -> None:
+        await self.leases.rebalance()
+        heartbeat = asyncio.get_running_loop().create_task(self._heartbeat())
+        try:
+            while True:
+                token = correlation_id.set(f"worker-{uuid.uuid4().hex[:8]}")
+                try:
+                    await run_checks(owns=self.leases.owns)
+                except Exception as e:
+                    log.error(f"Worker run failed: {e}")
+                finally:
+                    correlation_id.reset(token)
+                await asyncio.sleep(self.tick)
+        finally:
+            heartbeat.cancel()
+            await self.leases.leave()
+
+
+async def main() -> None:
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    worker = Worker(create_shard_leases(owner), tick=config.NOTIFIER_TICK, heartbeat=config.LEASE_HEARTBEAT)
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    log.info(f"Starting worker {owner}...")
+    try:
+        await worker.run()
+    except asyncio.CancelledError:
+        log.info(f"Stopping worker {owner}...")
+    finally:
+        await prefetcher.close()
+        await download_queue.close()
+        page_optimizer.close()
+        await backend.close()
+        browser_pool.close()
+        executors.shutdown()
+        database.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass